@@ -0,0 +1,142 @@
+import os
+import gc
+import sys
+import json
+import random
+import argparse
+import tracemalloc
+from time import perf_counter
+from typing import Callable
+from dataclasses import dataclass, field
+
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRPATH)
+
+from tools.spotify import _instantiate_track
+from tools.tracks import TrackColumns
+
+PAGE_SIZE = 100
+ARTISTS = 2000
+ADDED_AT_BATCHES = 500
+
+
+# the track representation before slots and interning, kept here as the baseline
+@dataclass
+class LegacyTrack:
+  id: str = field(hash=True)
+  name: str
+  artist: str
+  added_at: str | None = field(default=None)
+  key: int = field(init=False, default=None)
+  mode: int = field(init=False, default=None)
+  tempo: float = field(init=False, default=None)
+
+  def set_analytics(self, *, key: int, mode: int, tempo: float):
+    self.key = key
+    self.mode = mode
+    self.tempo = tempo
+
+def _instantiate_legacy_track(data: dict) -> LegacyTrack:
+  _data_track = data['track']
+  return LegacyTrack(
+    id=_data_track['id'],
+    name=_data_track['name'],
+    artist=', '.join(artist['name'] for artist in _data_track['artists']),
+    added_at=data.get('added_at')
+  )
+
+@dataclass
+class Representation:
+  name: str
+  instantiate: Callable[[dict], object]
+  create: Callable[[], object]
+  add: Callable[[object, object], None]
+  sort: Callable[[object], list[str]]
+
+REPRESENTATIONS = [
+  Representation(
+    name='dataclass list',
+    instantiate=_instantiate_legacy_track,
+    create=list,
+    add=list.append,
+    sort=lambda tracks: [track.id for track in sorted(tracks, key=lambda x: (x.tempo is None, x.tempo or 0))]
+  ),
+  Representation(
+    name='slotted list',
+    instantiate=_instantiate_track,
+    create=list,
+    add=list.append,
+    sort=lambda tracks: [track.id for track in sorted(tracks, key=lambda x: (x.tempo is None, x.tempo or 0))]
+  ),
+  Representation(
+    name='track columns',
+    instantiate=_instantiate_track,
+    create=TrackColumns,
+    add=lambda columns, track: columns.append(track.id, track.tempo),
+    sort=TrackColumns.get_ids_by_tempo
+  )
+]
+
+@dataclass
+class MemoryResult:
+  tracks: int
+  representation: str
+  retained_mb: float
+  bytes_per_track: int
+  sort_ms: float
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Compare how much memory each track representation retains for a compiled collection')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 500000], help='number of tracks to hold')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  results: list[MemoryResult] = []
+  for size in args.sizes:
+    pages = get_pages(size)
+    results.extend(measure(size, representation, pages) for representation in REPRESENTATIONS)
+  print(f'{"tracks":>8} {"representation":<16} {"retained MB":>12} {"B/track":>8} {"sort ms":>8}')
+  for result in results:
+    print(f'{result.tracks:>8} {result.representation:<16} {result.retained_mb:>12.1f} {result.bytes_per_track:>8} {result.sort_ms:>8.1f}')
+
+def get_pages(size: int) -> list[str]:
+  rng = random.Random(0)
+  items = [{
+    'added_at': f'2024-01-01T00:{i % ADDED_AT_BATCHES // 60:02d}:{i % ADDED_AT_BATCHES % 60:02d}Z',
+    'is_local': False,
+    'track': { 'type': 'track', 'id': f'{i:022d}', 'name': f'Track {i}', 'artists': [{ 'name': f'Artist {rng.randrange(ARTISTS)}' }] }
+  } for i in range(size)]
+  # kept as raw json so every page decodes into fresh strings, the way real responses do
+  return [json.dumps(items[offset:offset + PAGE_SIZE]) for offset in range(0, size, PAGE_SIZE)]
+
+def measure(size: int, representation: Representation, pages: list[str]) -> MemoryResult:
+  rng = random.Random(1)
+  gc.collect()
+  tracemalloc.start()
+  store = representation.create()
+  # pages are dropped once routed, so only what the store keeps alive is retained
+  for page in pages:
+    for item in json.loads(page):
+      track = representation.instantiate(item)
+      track.set_analytics(key=rng.randrange(12), mode=rng.randrange(2), tempo=round(rng.uniform(60, 180), 2))
+      representation.add(store, track)
+  del page, item, track
+  gc.collect()
+  retained_bytes, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  started_at = perf_counter()
+  representation.sort(store)
+  sort_ms = (perf_counter() - started_at) * 1000
+  return MemoryResult(
+    tracks=size,
+    representation=representation.name,
+    retained_mb=round(retained_bytes / 1024 / 1024, 1),
+    bytes_per_track=round(retained_bytes / size),
+    sort_ms=round(sort_ms, 1)
+  )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,265 @@
+import re
+import json
+import random
+import hashlib
+import threading
+from time import sleep
+from typing import Callable
+from dataclasses import dataclass, field
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ID_PARENTS = ('playlists', 'tracks', 'users', 'audio-analysis')
+ADDED_AT = '2024-01-01T00:00:00Z'
+# every scope the app asks for, so the mock's token is never sent back to authorize again
+SCOPE = 'playlist-read-private playlist-modify-public playlist-modify-private ugc-image-upload'
+
+
+@dataclass
+class MockTrack:
+  id: str
+  name: str
+  key: int
+  mode: int
+  tempo: float
+  added_at: str = ADDED_AT
+
+  def to_item(self) -> dict:
+    return {
+      'added_at': self.added_at,
+      'is_local': False,
+      'track': { 'type': 'track', 'id': self.id, 'name': self.name, 'artists': [{ 'name': 'Mock Artist' }] }
+    }
+
+  def to_features(self) -> dict:
+    return { 'id': self.id, 'key': self.key, 'mode': self.mode, 'tempo': self.tempo }
+
+@dataclass
+class MockPlaylist:
+  id: str
+  name: str
+  track_ids: list[str] = field(default_factory=list)
+  snapshot_id: str = 'snapshot-0'
+
+
+@dataclass
+class MockSpotify:
+  latency: float = 0
+  rate_429: float = 0
+  etags: bool = True
+  seed: int = 0
+  tracks: dict[str, MockTrack] = field(init=False, default_factory=dict)
+  playlists: dict[str, MockPlaylist] = field(init=False, default_factory=dict)
+  followed: set[str] = field(init=False, default_factory=set)
+  counts: dict[str, int] = field(init=False, default_factory=dict)
+  lock: threading.RLock = field(init=False, default_factory=threading.RLock)
+  rng: random.Random = field(init=False)
+  server: ThreadingHTTPServer | None = field(init=False, default=None)
+  snapshots: int = field(init=False, default=0)
+
+  def __post_init__(self):
+    self.rng = random.Random(self.seed)
+
+  def __enter__(self) -> 'MockSpotify':
+    self.start()
+    return self
+
+  def __exit__(self, *_):
+    self.stop()
+
+  @property
+  def api_url(self) -> str:
+    return f'http://127.0.0.1:{self.server.server_port}/v1'
+
+  @property
+  def auth_url(self) -> str:
+    return f'http://127.0.0.1:{self.server.server_port}'
+
+  def start(self) -> None:
+    mock = self
+    class Handler(MockRequestHandler):
+      spotify = mock
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def stop(self) -> None:
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+  def add_source_playlist(self, playlist_id: str, n_tracks: int) -> MockPlaylist:
+    with self.lock:
+      playlist = MockPlaylist(playlist_id, f'Source {playlist_id}')
+      self.playlists[playlist_id] = playlist
+      self.add_tracks(playlist_id, n_tracks)
+      return playlist
+
+  def add_tracks(self, playlist_id: str, n_tracks: int, added_at: str = ADDED_AT) -> None:
+    with self.lock:
+      playlist = self.playlists[playlist_id]
+      for _ in range(n_tracks):
+        track_id = f'{playlist_id}t{len(self.tracks)}'
+        self.tracks[track_id] = MockTrack(
+          id=track_id,
+          name=f'Track {track_id}',
+          key=self.rng.randrange(12),
+          mode=self.rng.randrange(2),
+          tempo=round(self.rng.uniform(60, 180), 2),
+          added_at=added_at
+        )
+        playlist.track_ids.append(track_id)
+      self.bump_snapshot(playlist)
+
+  def bump_snapshot(self, playlist: MockPlaylist) -> None:
+    self.snapshots += 1
+    playlist.snapshot_id = f'snapshot-{self.snapshots}'
+
+  def reset_counts(self) -> dict[str, int]:
+    with self.lock:
+      counts, self.counts = self.counts, {}
+      return counts
+
+  def count(self, method: str, path: str) -> None:
+    segments = path.split('/')
+    label = '/'.join('{id}' if i > 1 and segments[i - 1] in ID_PARENTS else segment for i, segment in enumerate(segments))
+    with self.lock:
+      self.counts[f'{method} {label}'] = self.counts.get(f'{method} {label}', 0) + 1
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+  spotify: MockSpotify
+  protocol_version = 'HTTP/1.1'
+  # headers and body go out as separate writes, which nagle would delay on keep-alive connections
+  disable_nagle_algorithm = True
+
+  def log_message(self, *_):
+    pass
+
+  def do_GET(self):
+    self.__handle('GET')
+
+  def do_POST(self):
+    self.__handle('POST')
+
+  def do_PUT(self):
+    self.__handle('PUT')
+
+  def do_DELETE(self):
+    self.__handle('DELETE')
+
+  def __handle(self, method: str) -> None:
+    url = urlparse(self.path)
+    query = dict(parse_qsl(url.query))
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else b''
+    self.spotify.count(method, url.path)
+    if self.spotify.latency:
+      sleep(self.spotify.latency)
+    if self.spotify.rate_429 and self.spotify.rng.random() < self.spotify.rate_429:
+      return self.__send(429, { 'error': { 'status': 429, 'message': 'API rate limit exceeded' } }, { 'Retry-After': '0' })
+    is_json = 'json' in (self.headers.get('Content-Type') or '')
+    with self.spotify.lock:
+      status, data = self.__route(method, url.path, query, json.loads(body) if body and is_json else {})
+    self.__send(status, data)
+
+  def __route(self, method: str, path: str, query: dict, body: dict) -> tuple[int, dict | list | None]:
+    spotify = self.spotify
+    if path == '/api/token':
+      return 200, { 'access_token': 'mock-access-token', 'expires_in': 3600, 'scope': SCOPE }
+    path = path.removeprefix('/v1')
+    if path == '/me':
+      return 200, { 'id': 'mock-user' }
+    if path == '/me/playlists':
+      playlists = [spotify.playlists[_id] for _id in sorted(spotify.followed)]
+      return 200, self.__get_page(playlists, query, path, self.__get_playlist_data)
+    if path == '/audio-features':
+      tracks = [spotify.tracks.get(track_id) for track_id in query['ids'].split(',')]
+      return 200, { 'audio_features': [track.to_features() if track else None for track in tracks] }
+    if match := re.fullmatch(r'/audio-analysis/([^/]+)', path):
+      if not (track := spotify.tracks.get(match[1])):
+        return self.__get_not_found()
+      return 200, { 'track': track.to_features() }
+    if re.fullmatch(r'/users/[^/]+/playlists', path):
+      playlist = MockPlaylist(f'collection{len(spotify.playlists)}', body['name'])
+      spotify.playlists[playlist.id] = playlist
+      spotify.followed.add(playlist.id)
+      return 201, self.__get_playlist_data(playlist)
+    if not (match := re.fullmatch(r'/playlists/([^/]+)(/.*)?', path)):
+      return self.__get_not_found()
+    playlist = spotify.playlists.get(match[1])
+    if not playlist:
+      return self.__get_not_found()
+    subpath = match[2] or ''
+    if subpath == '':
+      return 200, self.__get_playlist_data(playlist)
+    if subpath == '/images':
+      return 202, None
+    if subpath == '/followers/contains':
+      return 200, [playlist.id in spotify.followed]
+    if subpath == '/tracks':
+      return self.__route_playlist_tracks(method, playlist, query, body)
+    return self.__get_not_found()
+
+  def __route_playlist_tracks(self, method: str, playlist: MockPlaylist, query: dict, body: dict) -> tuple[int, dict]:
+    spotify = self.spotify
+    if method == 'GET':
+      return 200, self.__get_page(playlist.track_ids, query, f'/playlists/{playlist.id}/tracks', lambda track_id: spotify.tracks[track_id].to_item())
+    if method == 'POST':
+      track_ids = [uri.split(':')[-1] for uri in body['uris']]
+      position = body.get('position', query.get('position'))
+      position = len(playlist.track_ids) if position is None else int(position)
+      playlist.track_ids[position:position] = track_ids
+    elif method == 'DELETE':
+      removed_ids = {track['uri'].split(':')[-1] for track in body['tracks']}
+      playlist.track_ids = [track_id for track_id in playlist.track_ids if track_id not in removed_ids]
+    elif 'uris' in body or 'uris' in query:
+      uris = body['uris'] if 'uris' in body else query['uris'].split(',')
+      playlist.track_ids = [uri.split(':')[-1] for uri in uris]
+    else:
+      range_start, insert_before, range_length = body['range_start'], body['insert_before'], body.get('range_length', 1)
+      moved = playlist.track_ids[range_start:range_start + range_length]
+      rest = playlist.track_ids[:range_start] + playlist.track_ids[range_start + range_length:]
+      insert_at = insert_before if insert_before <= range_start else insert_before - range_length
+      playlist.track_ids = rest[:insert_at] + moved + rest[insert_at:]
+    spotify.bump_snapshot(playlist)
+    return 201 if method == 'POST' else 200, { 'snapshot_id': playlist.snapshot_id }
+
+  def __get_playlist_data(self, playlist: MockPlaylist) -> dict:
+    return {
+      'id': playlist.id,
+      'name': playlist.name,
+      'images': [],
+      'snapshot_id': playlist.snapshot_id,
+      'tracks': { 'total': len(playlist.track_ids) }
+    }
+
+  def __get_page(self, values: list, query: dict, path: str, to_item: Callable) -> dict:
+    offset, limit = int(query.get('offset', 0)), int(query.get('limit', 20))
+    has_next = offset + limit < len(values)
+    return {
+      'items': [to_item(value) for value in values[offset:offset + limit]],
+      'next': f'{self.spotify.api_url}{path}?offset={offset + limit}&limit={limit}' if has_next else None,
+      'total': len(values),
+      'offset': offset,
+      'limit': limit
+    }
+
+  def __get_not_found(self) -> tuple[int, dict]:
+    return 404, { 'error': { 'status': 404, 'message': 'Not found.' } }
+
+  def __send(self, status: int, data: dict | list | None, headers: dict[str, str] = {}) -> None:
+    raw = b'' if data is None else json.dumps(data).encode('utf8')
+    if self.spotify.etags and self.command == 'GET' and status == 200:
+      etag = f'"{hashlib.sha1(raw).hexdigest()}"'
+      headers = { **headers, 'ETag': etag }
+      if self.headers.get('If-None-Match') == etag:
+        status, raw = 304, b''
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(raw)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(raw)
@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from time import perf_counter
+from datetime import datetime
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field, asdict
+
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRPATH)
+
+from benchmarks.mock_spotify import MockSpotify
+
+SOURCE_PLAYLIST_ID = 'source'
+# added_at for tracks added between runs, later than anything already compiled
+CHANGED_ADDED_AT = '2025-01-01T00:00:00Z'
+
+
+@dataclass
+class BenchmarkOptions:
+  workers: int = 1
+  page_window: int = 1
+  http_cache_mb: int = 0
+  targets: int = 24
+
+@dataclass
+class ScenarioResult:
+  tracks: int
+  scenario: str
+  requests: int
+  wall_seconds: float
+  peak_rss_mb: float
+  sqlite_ms: float
+  api_ms: float
+  requests_by_endpoint: dict[str, int] = field(default_factory=dict)
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Benchmark a full compile against a local mock of the Spotify API')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='track counts of the source playlists')
+  parser.add_argument('--latency-ms', type=float, default=0, help='latency the mock adds to every request')
+  parser.add_argument('--rate-429', type=float, default=0, help='share of requests the mock rejects with 429')
+  parser.add_argument('--no-etags', action='store_true', help='stop the mock from sending ETags')
+  parser.add_argument('--targets', type=int, default=24, help='number of keys & modes to compile')
+  parser.add_argument('--workers', type=int, default=1)
+  parser.add_argument('--page-window', type=int, default=1)
+  parser.add_argument('--http-cache-mb', type=int, default=0)
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--child', help=argparse.SUPPRESS)
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  if args.child:
+    run_child(**json.loads(args.child))
+    return
+  options = BenchmarkOptions(
+    workers=args.workers,
+    page_window=args.page_window,
+    http_cache_mb=args.http_cache_mb,
+    targets=args.targets
+  )
+  results: list[ScenarioResult] = []
+  for size in args.sizes:
+    with MockSpotify(latency=args.latency_ms / 1000, rate_429=args.rate_429, etags=not args.no_etags) as mock:
+      mock.add_source_playlist(SOURCE_PLAYLIST_ID, size)
+      results.extend(run_scenarios(mock, size, options))
+  print_results(results)
+  if args.output:
+    with open(args.output, mode='w', encoding='utf8') as f:
+      json.dump({ 'options': asdict(options), 'results': [asdict(result) for result in results] }, f, indent=2)
+
+def run_scenarios(mock: MockSpotify, size: int, options: BenchmarkOptions) -> list[ScenarioResult]:
+  workdir = tempfile.mkdtemp(prefix='keykeeper-benchmark-')
+  try:
+    # the app resolves data/ and fonts/ against the working directory
+    os.makedirs(f'{workdir}/data')
+    os.symlink(f'{REPO_DIRPATH}/fonts', f'{workdir}/fonts')
+    with open(f'{workdir}/data/refresh_token.txt', mode='w', encoding='utf8') as f:
+      f.write('mock-refresh-token')
+    results = [
+      run_scenario(mock, size, 'cold', workdir, options),
+      run_scenario(mock, size, 'warm-unchanged', workdir, options)
+    ]
+    mock.add_tracks(SOURCE_PLAYLIST_ID, max(size // 100, 1), added_at=CHANGED_ADDED_AT)
+    results.append(run_scenario(mock, size, 'warm-changed', workdir, options))
+    return results
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+def run_scenario(mock: MockSpotify, size: int, scenario: str, workdir: str, options: BenchmarkOptions) -> ScenarioResult:
+  mock.reset_counts()
+  child_args = json.dumps({ 'api_url': mock.api_url, 'auth_url': mock.auth_url, **asdict(options) })
+  # a fresh process per scenario keeps peak RSS meaningful
+  process = subprocess.run(
+    [sys.executable, os.path.abspath(__file__), '--child', child_args],
+    cwd=workdir,
+    capture_output=True,
+    text=True
+  )
+  if process.returncode:
+    raise RuntimeError(f'{scenario} benchmark with {size} tracks failed:\n{process.stderr}')
+  child_result = json.loads(process.stdout.strip().splitlines()[-1])
+  counts = mock.reset_counts()
+  return ScenarioResult(
+    tracks=size,
+    scenario=scenario,
+    requests=sum(counts.values()),
+    requests_by_endpoint=dict(sorted(counts.items())),
+    **child_result
+  )
+
+def run_child(*, api_url: str, auth_url: str, workers: int, page_window: int, http_cache_mb: int, targets: int) -> None:
+  from tools import spotify as spotify_module
+  from tools.db import SQLite
+  from tools.cache import HTTPCache
+  from tools.metrics import metrics
+  from tools.handler import SpotifySQLHandler, CollectionTarget
+  from utils.setup import get_pool_size
+
+  spotify_module.BASE_URLS['api'] = api_url
+  spotify_module.BASE_URLS['auth'] = auth_url
+  started_at = perf_counter()
+  with open(os.devnull, mode='w') as devnull, redirect_stdout(devnull), SQLite() as sql:
+    http_cache = HTTPCache(max_bytes=http_cache_mb * 1024 * 1024) if http_cache_mb else None
+    pool_size = get_pool_size(workers=workers, playlist_workers=1, page_window=page_window)
+    spotify = spotify_module.SpotifyAPI(client_id='mock', client_secret='mock', redirect_uri='mock', http_cache=http_cache, page_window=page_window, pool_size=pool_size)
+    keys, modes = sql.get_all_keys(), list(reversed(sql.get_all_modes()))
+    collection_targets = [CollectionTarget(key, mode) for mode in modes for key in keys][:targets]
+    handler = SpotifySQLHandler(spotify=spotify, sql=sql, workers=workers)
+    handler.iterate_playlists(targets=collection_targets, playlists=[spotify.get_playlist(SOURCE_PLAYLIST_ID)])
+  wall_seconds = perf_counter() - started_at
+  report = metrics.get_report()
+  print(json.dumps({
+    'wall_seconds': round(wall_seconds, 3),
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    'sqlite_ms': round(sum(stats['total_ms'] for name, stats in report['timers'].items() if name.startswith('sql.')), 1),
+    'api_ms': round(sum(stats['total_ms'] for name, stats in report['timers'].items() if name.startswith('api.') and name != 'api.rate_limiter_wait'), 1)
+  }))
+
+def print_results(results: list[ScenarioResult]) -> None:
+  print(f'{"tracks":>8} {"scenario":<16} {"requests":>9} {"wall s":>8} {"rss MB":>8} {"sqlite ms":>10} {"api ms":>10}')
+  for result in results:
+    print(f'{result.tracks:>8} {result.scenario:<16} {result.requests:>9} {result.wall_seconds:>8.2f} {result.peak_rss_mb:>8.1f} {result.sqlite_ms:>10.1f} {result.api_ms:>10.1f}')
+  print(f'🏁 Benchmarked at {datetime.now().isoformat(timespec="seconds")}')
+
+
+if __name__ == '__main__':
+  main()
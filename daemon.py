@@ -0,0 +1,36 @@
+import argparse
+
+from tools.spotify import RateLimiter
+from tools.handler import SpotifySQLHandler
+from tools.db import SQLite
+from tools.cache import HTTPCache
+from tools.pil import CoverRenderer
+from tools.scheduler import Scheduler, SchedulerConfig, SCHEDULER_CONFIG_FP
+from utils.setup import init_spotify, check_setup
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Keep compiled Spotify playlists in sync without prompts')
+  parser.add_argument('--config', default=SCHEDULER_CONFIG_FP, help='path to the scheduler JSON config')
+  parser.add_argument('--once', action='store_true', help='run a single cycle and exit')
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+  assert check_setup(), 'Setup is incomplete. Run main.py once interactively first.'
+  config = SchedulerConfig.from_file(args.config)
+  with SQLite() as sql, CoverRenderer(processes=config.cover_processes) as cover_renderer:
+    http_cache = HTTPCache(max_bytes=config.http_cache_mb * 1024 * 1024) if config.http_cache_mb else None
+    spotify = init_spotify(http_cache=http_cache, rate_limiter=RateLimiter(config.requests_per_second), page_window=config.page_window, workers=config.workers)
+    if not spotify.check_scopes_granted():
+      print('⚠️  Your authorization is missing some permissions, run main.py once to authorize again. Until then, private collections are checked one by one.')
+    handler = SpotifySQLHandler(spotify=spotify, sql=sql, workers=config.workers, cover_renderer=cover_renderer)
+    scheduler = Scheduler(config=config, spotify=spotify, sql=sql, handler=handler)
+    if args.once:
+      scheduler.run_cycle()
+    else:
+      scheduler.run_forever()
+
+
+if __name__ == '__main__':
+  main()
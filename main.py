@@ -1,6 +1,15 @@
+import os
+import pstats
+import argparse
+import cProfile
+
 from tools.prompter import Prompter
+from tools.spotify import SpotifyAPI
 from tools.handler import SpotifySQLHandler
 from tools.db import SQLite
+from tools.cache import HTTPCache
+from tools.pil import CoverRenderer
+from tools.metrics import metrics, REPORTS_DIRPATH
 from utils.setup import init_spotify, check_setup, run_setup
 
 
@@ -8,14 +17,50 @@ def control_setup():
   if not check_setup():
     run_setup()
 
+def control_scopes(spotify: SpotifyAPI):
+  if not spotify.check_scopes_granted():
+    print('🔑 Your authorization is missing some of the permissions this script needs. Authorizing again...')
+    spotify.authorize()
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Compile Spotify playlists by key & mode')
+  parser.add_argument('--workers', type=int, default=1, help='number of analytics requests to keep in flight')
+  parser.add_argument('--playlist-workers', type=int, default=1, help='number of source playlists to compile at the same time')
+  parser.add_argument('--page-window', type=int, default=1, help='number of playlist pages to fetch ahead of the one being processed (0 disables prefetching)')
+  parser.add_argument('--http-cache-mb', type=int, default=0, help='size of the on-disk ETag cache for GET requests (0 disables it)')
+  parser.add_argument('--cover-processes', type=int, default=os.cpu_count() or 1, help='number of processes pre-rendering collection covers (0 renders them inline)')
+  parser.add_argument('--profile', action='store_true', help=f'profile the compilation with cProfile and save the stats to {REPORTS_DIRPATH}')
+  return parser.parse_args()
+
+def run_profiled(func, **kwargs):
+  profiler = cProfile.Profile()
+  profiler.runcall(func, **kwargs)
+  os.makedirs(REPORTS_DIRPATH, exist_ok=True)
+  profile_fp = f'{REPORTS_DIRPATH}/profile-{metrics.started_at.strftime("%Y%m%d-%H%M%S")}.prof'
+  profiler.dump_stats(profile_fp)
+  pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+  print(f'🔬 Profile written to {profile_fp}')
+
 def main():
+  args = parse_args()
   control_setup()
-  with SQLite() as sql:
-    key, mode = Prompter.get_key_and_mode(sql)
-    spotify = init_spotify()
+  with SQLite() as sql, CoverRenderer(processes=args.cover_processes) as cover_renderer:
+    targets = Prompter.get_key_and_mode(sql)
+    http_cache = HTTPCache(max_bytes=args.http_cache_mb * 1024 * 1024) if args.http_cache_mb else None
+    spotify = init_spotify(http_cache=http_cache, page_window=args.page_window, workers=args.workers, playlist_workers=args.playlist_workers)
+    control_scopes(spotify)
     playlists = Prompter.get_playlists(spotify)
-    handler = SpotifySQLHandler(spotify=spotify, sql=sql)
-    handler.iterate_playlists(key=key, mode=mode, playlists=playlists)
+    # the report covers the compilation, not the time spent answering prompts
+    metrics.reset()
+    handler = SpotifySQLHandler(spotify=spotify, sql=sql, workers=args.workers, playlist_workers=args.playlist_workers, cover_renderer=cover_renderer)
+    if args.profile:
+      run_profiled(handler.iterate_playlists, targets=targets, playlists=playlists)
+    else:
+      handler.iterate_playlists(targets=targets, playlists=playlists)
+    if http_cache:
+      print(f'📦 HTTP cache: {http_cache}')
+    report_fp = metrics.write_report(http_cache=repr(http_cache) if http_cache else None)
+    print(f'📈 Performance report written to {report_fp}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from urllib.parse import urlencode
+
+from utils.vars import DATA_DIRPATH
+
+HTTP_CACHE_DIRPATH = f'{DATA_DIRPATH}/http_cache'
+HTTP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+@dataclass
+class HTTPCacheEntry:
+  etag: str
+  body: bytes
+
+
+@dataclass
+class HTTPCache:
+  dirpath: str = HTTP_CACHE_DIRPATH
+  max_bytes: int = HTTP_CACHE_MAX_BYTES
+  hits: int = field(init=False, default=0)
+  misses: int = field(init=False, default=0)
+  not_modified: int = field(init=False, default=0)
+  sizes: OrderedDict[str, int] = field(init=False, default_factory=OrderedDict)
+  total_bytes: int = field(init=False, default=0)
+  lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+  def __post_init__(self):
+    os.makedirs(self.dirpath, exist_ok=True)
+    self.__load_sizes()
+
+  def __repr__(self):
+    return f'{self.hits} hits ({self.not_modified} not modified), {self.misses} misses, {self.total_bytes // 1024} KB stored'
+
+  @classmethod
+  def get_key(cls, url: str, params: dict = {}) -> str:
+    query = urlencode(sorted(params.items()), doseq=True)
+    return hashlib.sha1(f'{url}?{query}'.encode('utf8')).hexdigest()
+
+  def get(self, key: str) -> HTTPCacheEntry | None:
+    with self.lock:
+      if key not in self.sizes:
+        self.misses += 1
+        return None
+      self.sizes.move_to_end(key)
+      self.hits += 1
+    try:
+      with open(self.__get_filepath(key), mode='rb') as f:
+        etag, body = f.read().split(b'\n', 1)
+    except (OSError, ValueError):
+      with self.lock:
+        self.hits -= 1
+        self.misses += 1
+      return None
+    try:
+      os.utime(self.__get_filepath(key))
+    except FileNotFoundError:
+      pass
+    return HTTPCacheEntry(etag.decode('utf8'), body)
+
+  def count_not_modified(self) -> None:
+    with self.lock:
+      self.not_modified += 1
+
+  def store(self, key: str, etag: str, body: bytes) -> None:
+    content = etag.encode('utf8') + b'\n' + body
+    if len(content) > self.max_bytes:
+      return
+    filepath = self.__get_filepath(key)
+    # write through a temporary file so concurrent readers never see a partial entry
+    tmp_filepath = f'{filepath}.{threading.get_ident()}.tmp'
+    with open(tmp_filepath, mode='wb') as f:
+      f.write(content)
+    os.replace(tmp_filepath, filepath)
+    with self.lock:
+      self.total_bytes += len(content) - self.sizes.pop(key, 0)
+      self.sizes[key] = len(content)
+      self.__evict()
+
+  def __evict(self) -> None:
+    while self.total_bytes > self.max_bytes and self.sizes:
+      key, size = self.sizes.popitem(last=False)
+      self.total_bytes -= size
+      try:
+        os.remove(self.__get_filepath(key))
+      except FileNotFoundError:
+        pass
+
+  def __load_sizes(self) -> None:
+    entries = [entry for entry in os.scandir(self.dirpath) if entry.is_file() and not entry.name.endswith('.tmp')]
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+      self.sizes[entry.name] = entry.stat().st_size
+      self.total_bytes += entry.stat().st_size
+    self.__evict()
+
+  def __get_filepath(self, key: str) -> str:
+    return f'{self.dirpath}/{key}'
@@ -1,10 +1,18 @@
+import json
 import sqlite3
+import threading
+from queue import Queue
 from functools import wraps
-from dataclasses import dataclass, field
+from contextlib import contextmanager
+from concurrent.futures import Future
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Generator, Iterable
 
+from tools.metrics import metrics
 from utils.vars import DATA_DIRPATH
 
 DB_FP = f'{DATA_DIRPATH}/sqlite.db'
+SCHEMA_VERSION = 4
 KEYS = [
   (0, 'C'), (1, 'C#'),
   (2, 'D'), (3, 'D#'),
@@ -17,6 +25,11 @@ KEYS = [
 MODES = [
   (0, 'Minor'), (1, 'Major')
 ]
+TRACK_NEIGHBORS = ('exact', 'relative', 'camelot')
+SQL_MUTATIONS = {
+  'add_collection', 'delete_collections', 'update_collection_snapshots',
+  'add_track', 'add_track_analytics', 'replace_source_tracks'
+}
 
 @dataclass
 class SQLKeyMode:
@@ -32,8 +45,12 @@ class SQLCollection:
   playlist_id: str
   key: int
   mode: int
+  source_snapshot_id: str | None = None
+  collection_snapshot_id: str | None = None
+  added_at_watermark: str | None = None
+  track_filter: str = ''
 
-@dataclass
+@dataclass(slots=True)
 class SQLTrack:
   id: str
   tempo: float
@@ -43,17 +60,97 @@ class SQLTrack:
       return self.id == other.id
     if isinstance(other, str):
       return self.id == other
-    
-@dataclass
+    return NotImplemented
+
+  def __hash__(self) -> int:
+    return hash(self.id)
+
+@dataclass(slots=True, frozen=True)
 class SQLTrackAnalytics:
   key: int
   mode: int
   tempo: float
 
+@dataclass(slots=True)
+class SQLSourceTrack:
+  id: str
+  added_at: str | None
+  key: int
+  mode: int
+  tempo: float
+
+@dataclass
+class SQLSourcePlaylist:
+  id: str
+  snapshot_id: str | None
+  added_at_watermark: str | None
+  tracks: int
+  tracks_without_analytics: int
+
+  def check_cached(self, snapshot_id: str | None) -> bool:
+    return snapshot_id is not None and self.snapshot_id == snapshot_id and not self.tracks_without_analytics
+
+@dataclass(frozen=True)
+class TrackQuery:
+  key_modes: frozenset[tuple[int, int]]
+  min_tempo: float | None = None
+  max_tempo: float | None = None
+
+  @classmethod
+  def for_keys(cls, keys: Iterable[int], modes: Iterable[int], *, min_tempo: float | None = None, max_tempo: float | None = None) -> 'TrackQuery':
+    return cls(frozenset((key, mode) for key in keys for mode in modes), min_tempo, max_tempo)
+
+  def with_relatives(self) -> 'TrackQuery':
+    return replace(self, key_modes=self.key_modes | {get_relative_key_mode(key, mode) for key, mode in self.key_modes if key >= 0})
+
+  def with_camelot_neighbors(self) -> 'TrackQuery':
+    # one step around the camelot wheel is a fifth up or down, across it is the relative major or minor
+    relatives = self.with_relatives()
+    fifths = {((key + step) % 12, mode) for key, mode in self.key_modes if key >= 0 for step in (5, 7)}
+    return replace(relatives, key_modes=relatives.key_modes | fifths)
+
+  def with_neighbors(self, neighbors: str) -> 'TrackQuery':
+    if neighbors == 'relative':
+      return self.with_relatives()
+    if neighbors == 'camelot':
+      return self.with_camelot_neighbors()
+    return self
+
+  @classmethod
+  def union(cls, queries: Iterable['TrackQuery']) -> 'TrackQuery':
+    # one query that answers for several collections, each of them still filters the result with matches
+    queries = list(queries)
+    min_tempos, max_tempos = [query.min_tempo for query in queries], [query.max_tempo for query in queries]
+    return cls(
+      frozenset().union(*(query.key_modes for query in queries)),
+      None if None in min_tempos else min(min_tempos),
+      None if None in max_tempos else max(max_tempos)
+    )
+
+  def matches(self, *, key: int | None, mode: int | None, tempo: float | None) -> bool:
+    if (key, mode) not in self.key_modes or tempo is None:
+      return False
+    min_tempo, max_tempo = self.get_tempo_range()
+    return min_tempo <= tempo <= max_tempo
+
+  def get_tempo_range(self) -> tuple[float, float]:
+    return (
+      float('-inf') if self.min_tempo is None else self.min_tempo,
+      float('inf') if self.max_tempo is None else self.max_tempo
+    )
+
+
+def get_relative_key_mode(key: int, mode: int) -> tuple[int, int]:
+  # a minor key shares its notes with the major key three semitones up
+  return ((key + 3) % 12, 1) if mode == 0 else ((key + 9) % 12, 0)
+
 
 @dataclass
 class SQLite:
   connection: sqlite3.Connection = field(init=False)
+  transaction_depth: int = field(init=False, default=0)
+  pending_tracks: list[tuple[str, str]] = field(init=False, default_factory=list)
+  pending_track_analytics: list[tuple[str, int, int, float]] = field(init=False, default_factory=list)
 
   class Decorators:
     @classmethod
@@ -62,13 +159,28 @@ class SQLite:
       def inner(*args, **kwargs):
         this: SQLite = args[0]
         result = func(*args, **kwargs)
-        this.connection.commit()
+        if not this.transaction_depth:
+          this._commit()
         return result
       return inner
 
+    @classmethod
+    def measure(_, func):
+      return metrics.timed(f'sql.{func.__name__}')(func)
+
+    @classmethod
+    def flush_pending(_, func):
+      @wraps(func)
+      def inner(*args, **kwargs):
+        this: SQLite = args[0]
+        this._flush_pending()
+        return func(*args, **kwargs)
+      return inner
+
   def __enter__(self) -> 'SQLite':
     self.__open_connection()
     self.__enable_foreign_keys()
+    self.initialize()
     return self
   
   def __exit__(self, *_):
@@ -76,54 +188,245 @@ class SQLite:
 
   def __open_connection(self):
     self.connection = sqlite3.connect(DB_FP)
+    self.__tune_connection()
+
+  def __tune_connection(self):
+    self.connection.execute('PRAGMA journal_mode = WAL')
+    self.connection.execute('PRAGMA synchronous = NORMAL')
+    self.connection.execute('PRAGMA temp_store = MEMORY')
+    self.connection.execute('PRAGMA cache_size = -16000')
 
   def __close_connection(self):
+    # keeps sqlite_stat1 fresh, source track queries size the analytics index from it
+    self.connection.execute('PRAGMA optimize')
     self.connection.close()
 
+  # TRANSACTIONS
+
+  @contextmanager
+  def transaction(self) -> Generator['SQLite', None, None]:
+    self.transaction_depth += 1
+    try:
+      yield self
+      if self.transaction_depth == 1:
+        self._flush_pending()
+    except BaseException:
+      if self.transaction_depth == 1:
+        self.pending_tracks.clear()
+        self.pending_track_analytics.clear()
+        self.connection.rollback()
+      raise
+    finally:
+      self.transaction_depth -= 1
+    if not self.transaction_depth:
+      self._commit()
+
+  def _commit(self) -> None:
+    with metrics.timer('sql.commit'):
+      self.connection.commit()
+
+  def _flush_pending(self) -> None:
+    if not (self.pending_tracks or self.pending_track_analytics):
+      return
+    metrics.count('sql.flushed_rows', len(self.pending_tracks) + len(self.pending_track_analytics))
+    with metrics.timer('sql.flush'):
+      self.__flush_pending()
+
+  def __flush_pending(self) -> None:
+    if self.pending_tracks:
+      self.connection.executemany('''
+        INSERT INTO collection_tracks (collection_id, track_id)
+        VALUES (?, ?)
+      ''', self.pending_tracks)
+      self.pending_tracks.clear()
+    if self.pending_track_analytics:
+      self.connection.executemany('''
+        INSERT OR REPLACE INTO track_analytics (id, key, mode, tempo)
+        VALUES (?, ?, ?, ?)
+      ''', self.pending_track_analytics)
+      self.pending_track_analytics.clear()
+
   # QUERIES
     
   @Decorators.handle_commit
-  def add_collection(self, *, collection_id: str, playlist_id: str, key: int, mode: int) -> None:
+  @Decorators.flush_pending
+  @Decorators.measure
+  def add_collection(self, *, collection_id: str, playlist_id: str, key: int, mode: int, track_filter: str) -> None:
     self.connection.execute('''
-      INSERT INTO collections (id, playlist_id, key, mode)
-      VALUES (?, ?, ?, ?)
-    ''', [collection_id, playlist_id, key, mode])
+      INSERT INTO collections (id, playlist_id, key, mode, track_filter)
+      VALUES (?, ?, ?, ?, ?)
+    ''', [collection_id, playlist_id, key, mode, track_filter])
     
   @Decorators.handle_commit
-  def delete_collection(self, collection_id: str) -> None:
+  @Decorators.flush_pending
+  @Decorators.measure
+  def delete_collections(self, collection_ids: list[str]) -> None:
     self.connection.execute('''
       DELETE FROM collections
-      WHERE id = ?
-    ''', [collection_id])
-    
-  def get_collection_by_data(self, *, playlist_id: str, key: int, mode: int) -> SQLCollection | None:
+      WHERE id IN (SELECT value FROM json_each(?))
+    ''', [json.dumps(collection_ids)])
+    # memberships are only kept for playlists that still have a collection
+    self.connection.execute('''
+      DELETE FROM source_playlists
+      WHERE id NOT IN (SELECT playlist_id FROM collections)
+    ''')
+
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_collection_ids(self) -> list[str]:
+    c = self.connection.execute('SELECT id FROM collections')
+    return [_id for (_id,) in c.fetchall()]
+
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_collection_by_data(self, *, playlist_id: str, key: int, mode: int, track_filter: str) -> SQLCollection | None:
     c = self.connection.execute('''
-      SELECT id FROM collections
+      SELECT id, source_snapshot_id, collection_snapshot_id, added_at_watermark FROM collections
       WHERE playlist_id = ?
-      AND key = ? AND mode = ?
-    ''', (playlist_id, key, mode))
+      AND key = ? AND mode = ? AND track_filter = ?
+    ''', (playlist_id, key, mode, track_filter))
     result = c.fetchone()
     if result:
-      return SQLCollection(result[0], playlist_id, key, mode)
+      _id, source_snapshot_id, collection_snapshot_id, added_at_watermark = result
+      return SQLCollection(_id, playlist_id, key, mode, source_snapshot_id, collection_snapshot_id, added_at_watermark, track_filter)
+
+  @Decorators.handle_commit
+  @Decorators.flush_pending
+  @Decorators.measure
+  def update_collection_snapshots(
+      self,
+      *,
+      collection_id: str,
+      source_snapshot_id: str | None,
+      collection_snapshot_id: str | None,
+      added_at_watermark: str | None
+    ) -> None:
+    self.connection.execute('''
+      UPDATE collections
+      SET source_snapshot_id = ?, collection_snapshot_id = ?, added_at_watermark = ?
+      WHERE id = ?
+    ''', [source_snapshot_id, collection_snapshot_id, added_at_watermark, collection_id])
   
-  def get_track_by_collection(self, *, track_id: str, collection_id: str) -> SQLTrack | None:
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_collection_tracks(self, collection_id: str) -> dict[str, SQLTrack]:
     c = self.connection.execute('''
-      SELECT id, tempo FROM tracks
-      WHERE id = ? AND collection_id = ?
-    ''', [track_id, collection_id])
-    if result := c.fetchone():
-      _id, tempo = result
-      return SQLTrack(_id, tempo)
-  
-  def get_track_analytics(self, track_id: str) -> SQLTrackAnalytics | None:
+      SELECT collection_tracks.track_id, track_analytics.tempo FROM collection_tracks
+      LEFT JOIN track_analytics ON track_analytics.id = collection_tracks.track_id
+      WHERE collection_tracks.collection_id = ?
+    ''', [collection_id])
+    return {_id: SQLTrack(_id, tempo) for (_id, tempo) in c.fetchall()}
+
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_tracks_analytics(self, track_ids: list[str]) -> dict[str, SQLTrackAnalytics]:
+    # the ids travel as one json array so any number of them fits in a single statement
     c = self.connection.execute('''
-      SELECT key, mode, tracks.tempo FROM collections
-      INNER JOIN tracks ON collections.id = tracks.collection_id
-      WHERE tracks.id = ?
-    ''', [track_id])
-    result = c.fetchone()
-    return SQLTrackAnalytics(*result) if result else None
+      SELECT id, key, mode, tempo FROM track_analytics
+      WHERE id IN (SELECT value FROM json_each(?))
+    ''', [json.dumps(track_ids)])
+    return {_id: SQLTrackAnalytics(key, mode, tempo) for (_id, key, mode, tempo) in c.fetchall()}
+
+  @Decorators.handle_commit
+  @Decorators.measure
+  def add_track_analytics(self, *, track_id: str, key: int, mode: int, tempo: float) -> None:
+    if self.transaction_depth:
+      self.pending_track_analytics.append((track_id, key, mode, tempo))
+      return
+    self.connection.execute('''
+      INSERT OR REPLACE INTO track_analytics (id, key, mode, tempo)
+      VALUES (?, ?, ?, ?)
+    ''', [track_id, key, mode, tempo])
   
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_source_playlist(self, playlist_id: str) -> SQLSourcePlaylist | None:
+    c = self.connection.execute('''
+      SELECT snapshot_id, added_at_watermark, (
+        SELECT COUNT(*) FROM source_tracks
+        WHERE playlist_id = source_playlists.id
+      ), (
+        SELECT COUNT(*) FROM source_tracks
+        LEFT JOIN track_analytics ON track_analytics.id = source_tracks.track_id
+        WHERE source_tracks.playlist_id = source_playlists.id AND track_analytics.id IS NULL
+      ) FROM source_playlists
+      WHERE id = ?
+    ''', [playlist_id])
+    if result := c.fetchone():
+      return SQLSourcePlaylist(playlist_id, *result)
+
+  @Decorators.handle_commit
+  @Decorators.flush_pending
+  @Decorators.measure
+  def replace_source_tracks(
+      self,
+      *,
+      playlist_id: str,
+      snapshot_id: str | None,
+      added_at_watermark: str | None,
+      tracks: list[tuple[str, str | None]]
+    ) -> None:
+    self.connection.execute('''
+      INSERT INTO source_playlists (id, snapshot_id, added_at_watermark)
+      VALUES (?, ?, ?)
+      ON CONFLICT (id) DO UPDATE SET snapshot_id = excluded.snapshot_id, added_at_watermark = excluded.added_at_watermark
+    ''', [playlist_id, snapshot_id, added_at_watermark])
+    self.connection.execute('''
+      DELETE FROM source_tracks
+      WHERE playlist_id = ?
+    ''', [playlist_id])
+    self.connection.executemany('''
+      INSERT OR IGNORE INTO source_tracks (playlist_id, track_id, added_at)
+      VALUES (?, ?, ?)
+    ''', ((playlist_id, track_id, added_at) for track_id, added_at in tracks))
+
+  @Decorators.flush_pending
+  @Decorators.measure
+  def get_source_tracks_by_query(self, *, playlist_id: str, query: TrackQuery) -> list[SQLSourceTrack]:
+    # the planner can't see how many (key, mode) pairs the query holds, so the join order is picked here:
+    # narrow queries range over the (key, mode, tempo) index and probe the membership, broad ones walk the membership
+    if self.__check_index_narrower(playlist_id, query):
+      tables = 'track_analytics CROSS JOIN source_tracks'
+    else:
+      tables = 'source_tracks CROSS JOIN track_analytics'
+    c = self.connection.execute(f'''
+      SELECT track_analytics.id, source_tracks.added_at, track_analytics.key, track_analytics.mode, track_analytics.tempo
+      FROM {tables}
+      WHERE source_tracks.playlist_id = ? AND source_tracks.track_id = track_analytics.id
+      AND (track_analytics.key, track_analytics.mode) IN (
+        SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+      )
+      AND track_analytics.tempo BETWEEN ? AND ?
+      ORDER BY track_analytics.tempo
+    ''', [playlist_id, json.dumps(sorted(query.key_modes)), *query.get_tempo_range()])
+    return [SQLSourceTrack(*result) for result in c.fetchall()]
+
+  def __check_index_narrower(self, playlist_id: str, query: TrackQuery) -> bool:
+    rows_per_key_mode = self.__get_rows_per_key_mode()
+    if rows_per_key_mode is None:
+      return False
+    c = self.connection.execute('''
+      SELECT COUNT(*) FROM source_tracks
+      WHERE playlist_id = ?
+    ''', [playlist_id])
+    # an index row is a sequential read, a membership row a probe into the much larger analytics table, about twice the cost
+    return rows_per_key_mode * len(query.key_modes) < 2 * c.fetchone()[0]
+
+  def __get_rows_per_key_mode(self) -> int | None:
+    # PRAGMA optimize keeps sqlite_stat1 current, its third figure for the index is the average rows per (key, mode)
+    c = self.connection.execute('''
+      SELECT 1 FROM sqlite_master
+      WHERE type = 'table' AND name = 'sqlite_stat1'
+    ''')
+    if not c.fetchone():
+      return None
+    c = self.connection.execute('''
+      SELECT stat FROM sqlite_stat1
+      WHERE tbl = 'track_analytics' AND idx = 'key_mode_tempo'
+    ''')
+    if result := c.fetchone():
+      return int(result[0].split()[2])
+
   def get_all_keys(self) -> list[SQLKeyMode]:
     c = self.connection.execute('SELECT id, name FROM keys')
     return [SQLKeyMode(id, name) for (id, name) in c.fetchall()]
@@ -133,26 +436,77 @@ class SQLite:
     return [SQLKeyMode(id, name) for (id, name) in c.fetchall()]
   
   @Decorators.handle_commit
-  def add_track(self, *, track_id: str, collection_id: str, tempo: float) -> None:
+  @Decorators.measure
+  def add_track(self, *, track_id: str, collection_id: str) -> None:
+    if self.transaction_depth:
+      self.pending_tracks.append((collection_id, track_id))
+      return
     self.connection.execute('''
-      INSERT INTO tracks (id, collection_id, tempo)
-      VALUES (?, ?, ?)
-    ''', [track_id, collection_id, tempo])
+      INSERT INTO collection_tracks (collection_id, track_id)
+      VALUES (?, ?)
+    ''', [collection_id, track_id])
 
   # INITIALIZING DATABASE
 
   @Decorators.handle_commit
   def initialize(self):
-    self.__prepare_tables()
+    self.__migrate()
 
   def __enable_foreign_keys(self):
     self.connection.execute('PRAGMA foreign_keys = ON')
 
-  def __prepare_tables(self):
+  def __get_schema_version(self) -> int:
+    c = self.connection.execute('PRAGMA user_version')
+    return c.fetchone()[0]
+
+  def __migrate(self):
+    migrations = [self.__migrate_to_v1, self.__migrate_to_v2, self.__migrate_to_v3, self.__migrate_to_v4]
+    version = self.__get_schema_version()
+    for next_version, migration in enumerate(migrations[version:SCHEMA_VERSION], start=version + 1):
+      self.connection.execute('BEGIN')
+      migration()
+      self.connection.execute(f'PRAGMA user_version = {next_version}')
+      self.connection.commit()
+
+  # MIGRATIONS
+
+  def __migrate_to_v1(self):
+    # unversioned databases may predate the analytics cache or the snapshot columns, every step is idempotent
     self.__prepare_keys_table()
     self.__prepare_modes_table()
     self.__prepare_collections_table()
     self.__prepare_tracks_table()
+    self.__prepare_track_analytics_table()
+
+  def __migrate_to_v2(self):
+    self.__prepare_collection_tracks_table()
+    self.connection.execute('''
+      INSERT OR IGNORE INTO collection_tracks (collection_id, track_id)
+      SELECT collection_id, id FROM tracks
+      WHERE collection_id IS NOT NULL
+    ''')
+    self.connection.execute('DROP TABLE tracks')
+    self.__rebuild_track_analytics_table()
+
+  def __migrate_to_v3(self):
+    self.__prepare_source_tracks_tables()
+    # track_analytics is clustered on the id, so this index also covers it and the filters never touch the table
+    self.connection.execute('''
+      CREATE INDEX key_mode_tempo
+      ON track_analytics (key, mode, tempo)
+    ''')
+
+  def __migrate_to_v4(self):
+    # a key & mode can be compiled from the same playlist once per filter, existing collections have none
+    self.connection.execute('''
+      ALTER TABLE collections
+      ADD COLUMN track_filter TEXT NOT NULL DEFAULT ''
+    ''')
+    self.connection.execute('DROP INDEX playlist_key_mode')
+    self.connection.execute('''
+      CREATE UNIQUE INDEX playlist_key_mode_filter
+      ON collections (playlist_id, key, mode, track_filter)
+    ''')
 
   def __prepare_keys_table(self):
     self.connection.execute('''
@@ -194,6 +548,14 @@ class SQLite:
       CREATE UNIQUE INDEX IF NOT EXISTS playlist_key_mode
       ON collections (playlist_id, key, mode)
     ''')
+    self.__prepare_collection_snapshot_columns()
+
+  def __prepare_collection_snapshot_columns(self):
+    c = self.connection.execute('PRAGMA table_info(collections)')
+    columns = {name for (_, name, *_) in c.fetchall()}
+    for column in ['source_snapshot_id', 'collection_snapshot_id', 'added_at_watermark']:
+      if column not in columns:
+        self.connection.execute(f'ALTER TABLE collections ADD COLUMN {column} TEXT')
 
   def __prepare_tracks_table(self):
     self.connection.execute('''
@@ -205,3 +567,179 @@ class SQLite:
         FOREIGN KEY (collection_id) REFERENCES collections(id) ON DELETE CASCADE
       )
     ''')
+
+  def __prepare_track_analytics_table(self):
+    c = self.connection.execute('''
+      SELECT 1 FROM sqlite_master
+      WHERE type = 'table' AND name = 'track_analytics'
+    ''')
+    if c.fetchone():
+      return
+    # key and mode don't reference their tables, spotify reports -1 for tracks without a detectable key
+    self.connection.execute('''
+      CREATE TABLE track_analytics (
+        id TEXT PRIMARY KEY,
+        key INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        tempo REAL NOT NULL
+      )
+    ''')
+    # carry over analytics of tracks that were cached before this table existed
+    self.connection.execute('''
+      INSERT OR IGNORE INTO track_analytics (id, key, mode, tempo)
+      SELECT tracks.id, collections.key, collections.mode, tracks.tempo FROM tracks
+      INNER JOIN collections ON collections.id = tracks.collection_id
+    ''')
+
+  def __prepare_collection_tracks_table(self):
+    self.connection.execute('''
+      CREATE TABLE collection_tracks (
+        collection_id TEXT NOT NULL,
+        track_id TEXT NOT NULL,
+
+        PRIMARY KEY (collection_id, track_id)
+        FOREIGN KEY (collection_id) REFERENCES collections(id) ON DELETE CASCADE
+      ) WITHOUT ROWID
+    ''')
+    self.connection.execute('''
+      CREATE INDEX track_collections
+      ON collection_tracks (track_id, collection_id)
+    ''')
+
+  def __rebuild_track_analytics_table(self):
+    # clustering the rows on the track id keeps analytics lookups to a single b-tree search
+    self.connection.execute('''
+      CREATE TABLE track_analytics_clustered (
+        id TEXT PRIMARY KEY,
+        key INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        tempo REAL NOT NULL
+      ) WITHOUT ROWID
+    ''')
+    self.connection.execute('''
+      INSERT INTO track_analytics_clustered (id, key, mode, tempo)
+      SELECT id, key, mode, tempo FROM track_analytics
+    ''')
+    self.connection.execute('DROP TABLE track_analytics')
+    self.connection.execute('ALTER TABLE track_analytics_clustered RENAME TO track_analytics')
+
+  def __prepare_source_tracks_tables(self):
+    self.connection.execute('''
+      CREATE TABLE source_playlists (
+        id TEXT PRIMARY KEY,
+        snapshot_id TEXT,
+        added_at_watermark TEXT
+      )
+    ''')
+    self.connection.execute('''
+      CREATE TABLE source_tracks (
+        playlist_id TEXT NOT NULL,
+        track_id TEXT NOT NULL,
+        added_at TEXT,
+
+        PRIMARY KEY (playlist_id, track_id)
+        FOREIGN KEY (playlist_id) REFERENCES source_playlists(id) ON DELETE CASCADE
+      ) WITHOUT ROWID
+    ''')
+
+
+@dataclass
+class SQLiteWriter:
+  sql: SQLite
+  calls: Queue[tuple[Future, Callable, tuple, dict] | None] = field(init=False, default_factory=Queue)
+  lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+  closed: bool = field(init=False, default=False)
+
+  def call(self, func: Callable, *args, **kwargs) -> Any:
+    future = Future()
+    with self.lock:
+      if self.closed:
+        raise RuntimeError('SQLite writer is closed')
+      self.calls.put((future, func, args, kwargs))
+    return future.result()
+
+  def serve(self, futures: list[Future]) -> None:
+    # runs on the thread that owns the connection until every worker is finished
+    remaining = len(futures)
+    for future in futures:
+      future.add_done_callback(lambda _: self.calls.put(None))
+    future: Future | None = None
+    try:
+      while remaining:
+        call = self.calls.get()
+        if call is None:
+          remaining -= 1
+          continue
+        future, func, args, kwargs = call
+        try:
+          future.set_result(func(*args, **kwargs))
+        except Exception as e:
+          future.set_exception(e)
+    finally:
+      # an interrupt leaves the writer for good, so no worker may be left waiting on it
+      self.__close(future)
+
+  def __close(self, current: Future | None) -> None:
+    with self.lock:
+      self.closed = True
+    pending = [current]
+    while not self.calls.empty():
+      pending.append((self.calls.get_nowait() or (None,))[0])
+    for future in pending:
+      if future and not future.done():
+        future.set_exception(RuntimeError('SQLite writer is closed'))
+
+  def replay(self, calls: list[tuple[str, tuple, dict]]) -> None:
+    with self.sql.transaction():
+      for name, args, kwargs in calls:
+        getattr(self.sql, name)(*args, **kwargs)
+
+class SQLiteProxy:
+  writer: SQLiteWriter
+  transaction_depth: int
+  pending_calls: list[tuple[str, tuple, dict]]
+  pending_track_analytics: dict[str, SQLTrackAnalytics]
+
+  def __init__(self, writer: SQLiteWriter):
+    self.writer = writer
+    self.transaction_depth = 0
+    self.pending_calls = []
+    self.pending_track_analytics = {}
+
+  def __getattr__(self, name: str) -> Callable:
+    return self.__get_forwarder(name)
+
+  def __get_forwarder(self, name: str) -> Callable:
+    func = getattr(self.writer.sql, name)
+    def forward(*args, **kwargs):
+      # writes made inside a transaction are sent to the writer in one batch when it closes
+      if self.transaction_depth and name in SQL_MUTATIONS:
+        self.pending_calls.append((name, args, kwargs))
+        return
+      return self.writer.call(func, *args, **kwargs)
+    return forward
+
+  @contextmanager
+  def transaction(self) -> Generator['SQLiteProxy', None, None]:
+    self.transaction_depth += 1
+    try:
+      yield self
+      if self.transaction_depth == 1:
+        self.writer.call(self.writer.replay, self.pending_calls)
+    finally:
+      self.transaction_depth -= 1
+      if not self.transaction_depth:
+        self.pending_calls = []
+        self.pending_track_analytics.clear()
+
+  def add_track_analytics(self, *, track_id: str, key: int, mode: int, tempo: float) -> None:
+    if self.transaction_depth:
+      self.pending_track_analytics[track_id] = SQLTrackAnalytics(key, mode, tempo)
+    self.__get_forwarder('add_track_analytics')(track_id=track_id, key=key, mode=mode, tempo=tempo)
+
+  def get_tracks_analytics(self, track_ids: list[str]) -> dict[str, SQLTrackAnalytics]:
+    tracks_analytics = self.writer.call(self.writer.sql.get_tracks_analytics, track_ids)
+    for track_id in track_ids:
+      if track_id in self.pending_track_analytics:
+        tracks_analytics[track_id] = self.pending_track_analytics[track_id]
+    return tracks_analytics
@@ -1,132 +1,448 @@
-from typing import TypeAlias
+import copy
+from itertools import count
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from tools.spotify import SpotifyAPI, SpotifyPlaylist, SpotifyTrack
-from tools.db import SQLite, SQLKeyMode, SQLTrack
-from tools.pil import get_encoded_cover
+from tools.db import SQLite, SQLiteProxy, SQLiteWriter, SQLKeyMode, SQLTrack, SQLSourceTrack, TrackQuery
+from tools.pil import CoverRenderer
+from tools.sync import plan_sync
+from tools.tracks import TrackColumns
+from tools.metrics import metrics
 from utils.misc import chunk_list
 
-SharedTrackList: TypeAlias = list[SpotifyTrack | SQLTrack]
+
+NEIGHBOR_LABELS = {
+  'exact': '',
+  'relative': ' + relative',
+  'camelot': ' + Camelot neighbours'
+}
+NEIGHBOR_DESCRIPTIONS = {
+  'exact': '',
+  'relative': ' or its relative key',
+  'camelot': ' or a key next to it on the Camelot wheel'
+}
+
+
+@dataclass
+class CollectionTarget:
+  key: SQLKeyMode
+  mode: SQLKeyMode
+  neighbors: str = 'exact'
+  min_tempo: float | None = None
+  max_tempo: float | None = None
+  query: TrackQuery = field(init=False)
+
+  def __post_init__(self):
+    query = TrackQuery.for_keys([self.key.id], [self.mode.id], min_tempo=self.min_tempo, max_tempo=self.max_tempo)
+    self.query = query.with_neighbors(self.neighbors)
+
+  def __repr__(self):
+    return f'{self.key} {self.mode}{NEIGHBOR_LABELS[self.neighbors]}{self.__get_tempo_label()}'
+
+  @property
+  def track_filter(self) -> str:
+    # identifies the collection next to its playlist, key & mode, so it's empty for plain key & mode collections
+    if self.neighbors == 'exact' and self.min_tempo is None and self.max_tempo is None:
+      return ''
+    return f'{self.neighbors}:{_format_tempo(self.min_tempo)}-{_format_tempo(self.max_tempo)}'
+
+  def get_description(self) -> str:
+    return f'the key of {self.key} {self.mode}{NEIGHBOR_DESCRIPTIONS[self.neighbors]}{self.__get_tempo_label()}'
+
+  def __get_tempo_label(self) -> str:
+    if self.min_tempo is None and self.max_tempo is None:
+      return ''
+    if self.max_tempo is None:
+      return f' • {_format_tempo(self.min_tempo)}+ BPM'
+    if self.min_tempo is None:
+      return f' • up to {_format_tempo(self.max_tempo)} BPM'
+    return f' • {_format_tempo(self.min_tempo)}–{_format_tempo(self.max_tempo)} BPM'
+
+def _format_tempo(tempo: float | None) -> str:
+  return '' if tempo is None else f'{tempo:g}'
+
+@dataclass
+class CollectionState:
+  target: CollectionTarget
+  collection_playlist_id: str
+  # None stands in for items that can't be synced (local files, unavailable tracks, episodes)
+  collection_playlist_tracks: list[SpotifyTrack | None]
+  final_tracks: TrackColumns = field(default_factory=TrackColumns)
+  known_tracks: dict[str, SQLTrack] = field(default_factory=dict)
+  collection_snapshot_id: str | None = None
+  added_at_watermark: str | None = None
+  is_unchanged: bool = False
+  collection_track_ids: set[str] = field(init=False)
+  final_track_ids: set[str] = field(init=False)
+
+  def __post_init__(self):
+    self.collection_track_ids = {track.id for track in self.collection_playlist_tracks if track}
+    self.final_track_ids = set(self.final_tracks)
+
+  def add_final_track(self, track: SpotifyTrack | SQLTrack) -> None:
+    self.final_tracks.append(track.id, track.tempo)
+    self.final_track_ids.add(track.id)
+
+  def add_known_track(self, track: SpotifyTrack | SQLSourceTrack) -> None:
+    self.known_tracks[track.id] = SQLTrack(track.id, track.tempo)
+
+  def check_already_compiled(self, track: SpotifyTrack | SQLSourceTrack) -> bool:
+    if not self.added_at_watermark or not track.added_at:
+      return False
+    return track.added_at < self.added_at_watermark
+
+@dataclass
+class PendingPage:
+  collection_tracks: list[tuple[CollectionState, SpotifyTrack, SQLTrack | None]]
+  missing_tracks: list[SpotifyTrack]
+  analytics_futures: list[Future]
 
 
 class SpotifySQLHandler:
   spotify: SpotifyAPI
-  sql: SQLite
+  sql: SQLite | SQLiteProxy
+  analytics_cache_hits: int
+  analytics_cache_misses: int
+  workers: int
+  playlist_workers: int
+  executor: ThreadPoolExecutor | None
+  cover_renderer: CoverRenderer
+  collection_snapshots: dict[str, str | None]
 
-  def __init__(self, *, spotify: SpotifyAPI, sql: SQLite):
+  def __init__(self, *, spotify: SpotifyAPI, sql: SQLite, workers: int = 1, playlist_workers: int = 1, cover_renderer: CoverRenderer | None = None):
     self.spotify = spotify
     self.sql = sql
+    self.cover_renderer = cover_renderer or CoverRenderer(processes=0)
+    self.workers = max(workers, 1)
+    self.playlist_workers = max(playlist_workers, 1)
+    self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    self.analytics_cache_hits = 0
+    self.analytics_cache_misses = 0
+    self.collection_snapshots = {}
 
-  def iterate_playlists(self, *, key: SQLKeyMode, mode: SQLKeyMode, playlists: list[SpotifyPlaylist]) -> None:
-      for playlist in playlists:
-        print(f'⌛ Compiling from "{playlist}"')
-        collection_playlist_id = self.get_collection_playlist_id(key=key, mode=mode, playlist=playlist)
-        collection_playlist_tracks, final_tracks = self.get_track_lists(collection_playlist_id=collection_playlist_id)
-        self.iterate_playlist_tracks(
-          key=key,
-          mode=mode,
-          playlist=playlist,
-          collection_playlist_id=collection_playlist_id,
-          collection_playlist_tracks=collection_playlist_tracks,
-          final_tracks=final_tracks
-        )
-        self.check_for_new_collection_tracks(
-          collection_playlist_id=collection_playlist_id,
-          collection_playlist_tracks=collection_playlist_tracks,
-          final_tracks=final_tracks
-        )
-        self.clear_current_collection(
-          collection_playlist_id=collection_playlist_id,
-          collection_playlist_tracks=collection_playlist_tracks
-        )
-        self.add_final_tracks_to_collection(
-          collection_playlist_id=collection_playlist_id,
-          final_tracks=final_tracks
-        )
+  def iterate_playlists(self, *, targets: list[CollectionTarget], playlists: list[SpotifyPlaylist]) -> None:
+      self.reconcile_collections()
+      self.prerender_covers(targets=targets, playlists=playlists)
+      if self.playlist_workers > 1 and len(playlists) > 1:
+        self.__iterate_playlists_concurrently(targets=targets, playlists=playlists)
+      else:
+        for playlist in playlists:
+          self.compile_playlist(targets=targets, playlist=playlist)
+      print(f'📊 Analytics cache: {self.analytics_cache_hits} hits, {self.analytics_cache_misses} misses')
       print('✅ Done!')
 
-  def create_collection_playlist(self, *, playlist: SpotifyPlaylist, key_str: str, mode_str: str) -> SpotifyPlaylist:
-    name = f'{playlist.name} • {key_str} {mode_str}'
-    description = f'All the tracks in "{playlist.name}" that might be in the key of {key_str} {mode_str}'
-    cover = get_encoded_cover(img_url=playlist.cover, text_key=key_str, text_mode=mode_str)
+  @metrics.timed('handler.compile_playlist')
+  def compile_playlist(self, *, targets: list[CollectionTarget], playlist: SpotifyPlaylist) -> bool:
+      print(f'⌛ Compiling {", ".join(map(repr, targets))} from "{playlist}"')
+      # metadata-only playlists (e.g. from the prompt cache) don't carry a snapshot yet
+      if playlist.snapshot_id is None:
+        playlist.snapshot_id = self.spotify.get_playlist_snapshot_id(playlist.id)
+      collections = [self.get_collection_state(target=target, playlist=playlist) for target in targets]
+      changed_collections = [collection for collection in collections if not collection.is_unchanged]
+      if not changed_collections:
+        print(f'⏭️  "{playlist}" is unchanged since the last run')
+        return False
+      with self.sql.transaction():
+        added_at_watermark = self.iterate_playlist_tracks(playlist=playlist, collections=changed_collections)
+        for collection in changed_collections:
+          self.check_for_new_collection_tracks(collection=collection)
+          collection_snapshot_id = self.sync_collection(collection=collection)
+          self.sql.update_collection_snapshots(
+            collection_id=collection.collection_playlist_id,
+            source_snapshot_id=playlist.snapshot_id,
+            collection_snapshot_id=collection_snapshot_id or collection.collection_snapshot_id,
+            added_at_watermark=max(filter(None, [added_at_watermark, collection.added_at_watermark]), default=None)
+          )
+      return True
+
+  def __iterate_playlists_concurrently(self, *, targets: list[CollectionTarget], playlists: list[SpotifyPlaylist]) -> None:
+      # workers share the rate-limited client, but only this thread touches the database
+      writer = SQLiteWriter(self.sql)
+      handlers = [self.__get_playlist_handler(SQLiteProxy(writer)) for _ in playlists]
+      finished = count(1)
+      with ThreadPoolExecutor(max_workers=self.playlist_workers) as executor:
+        futures = [
+          executor.submit(handler.__compile_playlist_isolated, targets=targets, playlist=playlist, finished=finished, total=len(playlists))
+          for handler, playlist in zip(handlers, playlists)
+        ]
+        try:
+          writer.serve(futures)
+        except BaseException:
+          # workers that haven't started would otherwise run against a closed writer before the pool can join
+          for future in futures:
+            future.cancel()
+          raise
+      for handler in handlers:
+        self.analytics_cache_hits += handler.analytics_cache_hits
+        self.analytics_cache_misses += handler.analytics_cache_misses
+      failed = [playlist for playlist, future in zip(playlists, futures) if not future.result()]
+      if failed:
+        print(f'⚠️  {len(failed)} of {len(playlists)} playlists failed: {", ".join(map(repr, failed))}')
+
+  def __get_playlist_handler(self, sql: SQLiteProxy) -> 'SpotifySQLHandler':
+      handler = copy.copy(self)
+      handler.sql = sql
+      handler.analytics_cache_hits = 0
+      handler.analytics_cache_misses = 0
+      return handler
+
+  def __compile_playlist_isolated(self, *, targets: list[CollectionTarget], playlist: SpotifyPlaylist, finished: count, total: int) -> bool:
+      try:
+        changed = self.compile_playlist(targets=targets, playlist=playlist)
+      except Exception as e:
+        print(f'❌ [{next(finished)}/{total}] "{playlist}" failed: {e!r}')
+        return False
+      print(f'{"✔️ " if changed else "⏭️ "} [{next(finished)}/{total}] "{playlist}" {"compiled" if changed else "unchanged"}')
+      return True
+
+  @metrics.timed('handler.reconcile_collections')
+  def reconcile_collections(self) -> None:
+      # one paged pass over the library replaces a follower check per collection
+      collection_ids = self.sql.get_collection_ids()
+      if not collection_ids:
+        return
+      followed_snapshots = self.spotify.get_followed_playlist_snapshots()
+      # the listing carries every collection's snapshot, so compiling doesn't have to fetch them one by one
+      self.collection_snapshots = followed_snapshots
+      missing_ids = [collection_id for collection_id in collection_ids if collection_id not in followed_snapshots]
+      # private playlists are left out of the listing without playlist-read-private, so only then is anything missing confirmed first
+      if self.spotify.check_scopes_granted():
+        deleted_ids = missing_ids
+      else:
+        deleted_ids = [collection_id for collection_id in missing_ids if not self.spotify.check_following_playlist(collection_id)]
+      if deleted_ids:
+        self.sql.delete_collections(deleted_ids)
+        print(f'🧹 Forgot {len(deleted_ids)} collections that were removed from your library')
+
+  def prerender_covers(self, *, targets: list[CollectionTarget], playlists: list[SpotifyPlaylist]) -> None:
+    # covers render in the background while earlier playlists are still being compiled
+    for playlist in playlists:
+      for target in targets:
+        if not self.sql.get_collection_by_data(playlist_id=playlist.id, key=target.key.id, mode=target.mode.id, track_filter=target.track_filter):
+          self.cover_renderer.submit(img_url=playlist.cover, text_key=target.key.name, text_mode=target.mode.name)
+
+  @metrics.timed('handler.get_collection_state')
+  def get_collection_state(self, *, target: CollectionTarget, playlist: SpotifyPlaylist) -> CollectionState:
+    collection_playlist_id = self.get_collection_playlist_id(target=target, playlist=playlist)
+    sql_collection = self.sql.get_collection_by_data(playlist_id=playlist.id, key=target.key.id, mode=target.mode.id, track_filter=target.track_filter)
+    # each listed snapshot is used once, anything synced after the listing is fetched again
+    collection_snapshot_id = self.collection_snapshots.pop(collection_playlist_id, None) or self.spotify.get_playlist_snapshot_id(collection_playlist_id)
+    is_unchanged = (
+      playlist.snapshot_id is not None
+      and sql_collection.source_snapshot_id == playlist.snapshot_id
+      and sql_collection.collection_snapshot_id == collection_snapshot_id
+    )
+    if is_unchanged:
+      return CollectionState(
+        target=target,
+        collection_playlist_id=collection_playlist_id,
+        collection_playlist_tracks=[],
+        collection_snapshot_id=collection_snapshot_id,
+        is_unchanged=True
+      )
+    collection_playlist_tracks, final_tracks = self.get_track_lists(collection_playlist_id=collection_playlist_id)
+    return CollectionState(
+      target=target,
+      collection_playlist_id=collection_playlist_id,
+      collection_playlist_tracks=collection_playlist_tracks,
+      final_tracks=final_tracks,
+      known_tracks=self.sql.get_collection_tracks(collection_playlist_id),
+      collection_snapshot_id=collection_snapshot_id,
+      added_at_watermark=sql_collection.added_at_watermark
+    )
+
+  @metrics.timed('handler.create_collection_playlist')
+  def create_collection_playlist(self, *, playlist: SpotifyPlaylist, target: CollectionTarget) -> SpotifyPlaylist:
+    name = f'{playlist.name} • {target}'
+    description = f'All the tracks in "{playlist.name}" that might be in {target.get_description()}'
+    cover = self.cover_renderer.get(img_url=playlist.cover, text_key=target.key.name, text_mode=target.mode.name)
     col_playlist = self.spotify.create_playlist(name, description, cover)
     return col_playlist
 
-  def set_track_analytics(self, track: SpotifyTrack) -> None:
-    sql_analytics = self.sql.get_track_analytics(track.id)
-    if sql_analytics:
-      track.set_analytics(key=sql_analytics.key, mode=sql_analytics.mode, tempo=sql_analytics.tempo)
-    else:
-      self.spotify.get_track_analytics(track)
+  @metrics.timed('handler.set_tracks_analytics')
+  def set_tracks_analytics(self, tracks: list[SpotifyTrack]) -> None:
+    missing_tracks = self.__set_cached_tracks_analytics(tracks)
+    analytics_futures = self.__fetch_tracks_analytics(missing_tracks)
+    self.__store_fetched_tracks_analytics(missing_tracks, analytics_futures)
 
-  def get_collection_playlist_id(self, *, key: SQLKeyMode, mode: SQLKeyMode, playlist: SpotifyPlaylist) -> str:
-      collection_playlist_id: str = None
+  def __set_cached_tracks_analytics(self, tracks: list[SpotifyTrack]) -> list[SpotifyTrack]:
+    missing_tracks: list[SpotifyTrack] = []
+    tracks_analytics = self.sql.get_tracks_analytics([track.id for track in tracks]) if tracks else {}
+    for track in tracks:
+      if sql_analytics := tracks_analytics.get(track.id):
+        track.set_analytics(key=sql_analytics.key, mode=sql_analytics.mode, tempo=sql_analytics.tempo)
+      else:
+        missing_tracks.append(track)
+    self.analytics_cache_hits += len(tracks) - len(missing_tracks)
+    self.analytics_cache_misses += len(missing_tracks)
+    metrics.count('handler.analytics_cache_hits', len(tracks) - len(missing_tracks))
+    metrics.count('handler.analytics_cache_misses', len(missing_tracks))
+    return missing_tracks
 
-      sql_collection = self.sql.get_collection_by_data(playlist_id=playlist.id, key=key.id, mode=mode.id)
+  def __fetch_tracks_analytics(self, tracks: list[SpotifyTrack]) -> list[Future]:
+    futures: list[Future] = []
+    for chunk in chunk_list(tracks, 100):
+      if self.executor:
+        futures.append(self.executor.submit(self.spotify.get_tracks_analytics, chunk))
+        continue
+      future = Future()
+      future.set_result(self.spotify.get_tracks_analytics(chunk))
+      futures.append(future)
+    return futures
 
-      if not sql_collection:
-        collection_playlist_id = self.create_collection_playlist(playlist=playlist, key_str=key.name, mode_str=mode.name).id
-      elif not self.spotify.check_following_playlist(sql_collection.id):
-        self.sql.delete_collection(sql_collection.id)
-        collection_playlist_id = self.create_collection_playlist(playlist=playlist, key_str=key.name, mode_str=mode.name).id
-        sql_collection = None
+  def __store_fetched_tracks_analytics(self, tracks: list[SpotifyTrack], futures: list[Future]) -> None:
+    # the futures only fill the tracks in place, SQLite is written from the connection's own thread
+    for future in futures:
+      future.result()
+    for track in tracks:
+      if track.tempo is not None:
+        self.sql.add_track_analytics(track_id=track.id, key=track.key, mode=track.mode, tempo=track.tempo)
 
-      if not sql_collection:
-        self.sql.add_collection(collection_id=collection_playlist_id, playlist_id=playlist.id, key=key.id, mode=mode.id)
-      else:
-        collection_playlist_id = sql_collection.id
+  @metrics.timed('handler.get_collection_playlist_id')
+  def get_collection_playlist_id(self, *, target: CollectionTarget, playlist: SpotifyPlaylist) -> str:
+      key, mode, track_filter = target.key.id, target.mode.id, target.track_filter
+      sql_collection = self.sql.get_collection_by_data(playlist_id=playlist.id, key=key, mode=mode, track_filter=track_filter)
+      if sql_collection:
+        return sql_collection.id
 
+      collection_playlist_id = self.create_collection_playlist(playlist=playlist, target=target).id
+      self.sql.add_collection(collection_id=collection_playlist_id, playlist_id=playlist.id, key=key, mode=mode, track_filter=track_filter)
       return collection_playlist_id
 
-  def get_track_lists(self, *, collection_playlist_id: SharedTrackList) -> tuple[list[SpotifyTrack], SharedTrackList]:
-      collection_playlist_tracks = list(self.spotify.get_playlist_tracks(collection_playlist_id))
-      final_tracks: SharedTrackList = []
+  @metrics.timed('handler.get_track_lists')
+  def get_track_lists(self, *, collection_playlist_id: str) -> tuple[list[SpotifyTrack | None], TrackColumns]:
+      collection_playlist_tracks = list(self.spotify.get_playlist_tracks(collection_playlist_id, keep_positions=True))
+      final_tracks = TrackColumns()
       return collection_playlist_tracks, final_tracks
 
-  def iterate_playlist_tracks(
-      self,
-      *,
-      key: SQLKeyMode,
-      mode: SQLKeyMode,
-      playlist: SpotifyPlaylist,
-      collection_playlist_id: SharedTrackList,
-      collection_playlist_tracks: list[SpotifyTrack],
-      final_tracks: SharedTrackList
-    ) -> None:
-      for playlist_track in self.spotify.get_playlist_tracks(playlist.id):
-        sql_collection_track = self.sql.get_track_by_collection(track_id=playlist_track.id, collection_id=collection_playlist_id)
+  @metrics.timed('handler.iterate_playlist_tracks')
+  def iterate_playlist_tracks(self, *, playlist: SpotifyPlaylist, collections: list[CollectionState]) -> str | None:
+      # an unchanged source whose tracks are all analysed is matched in SQL without listing it again
+      query = TrackQuery.union(collection.target.query for collection in collections)
+      cached_tracks = self.query_playlist_tracks(playlist=playlist, query=query)
+      if cached_tracks is not None:
+        self.__route_source_tracks(cached_tracks, collections)
+        return self.sql.get_source_playlist(playlist.id).added_at_watermark
+      added_at_watermark: str | None = None
+      source_tracks: list[tuple[str, str | None]] = []
+      pending_pages: deque[PendingPage] = deque()
+      for playlist_tracks in self.spotify.get_playlist_track_pages(playlist.id):
+        added_at_watermark = max(filter(None, [added_at_watermark, *(track.added_at for track in playlist_tracks)]), default=None)
+        source_tracks.extend((track.id, track.added_at) for track in playlist_tracks)
+        pending_pages.append(self.__prepare_page(playlist_tracks, collections))
+        if len(pending_pages) >= self.workers:
+          self.__route_page(pending_pages.popleft())
+      while pending_pages:
+        self.__route_page(pending_pages.popleft())
+      self.sql.replace_source_tracks(
+        playlist_id=playlist.id,
+        snapshot_id=playlist.snapshot_id,
+        added_at_watermark=added_at_watermark,
+        tracks=source_tracks
+      )
+      return added_at_watermark
+
+  @metrics.timed('handler.query_playlist_tracks')
+  def query_playlist_tracks(self, *, playlist: SpotifyPlaylist, query: TrackQuery) -> list[SQLSourceTrack] | None:
+      # None unless the cache holds the playlist's current snapshot with every track analysed
+      source_playlist = self.sql.get_source_playlist(playlist.id)
+      if not source_playlist or not source_playlist.check_cached(playlist.snapshot_id):
+        return None
+      return self.sql.get_source_tracks_by_query(playlist_id=playlist.id, query=query)
+
+  def __route_source_tracks(self, source_tracks: list[SQLSourceTrack], collections: list[CollectionState]) -> None:
+    metrics.count('handler.cached_source_tracks', len(source_tracks))
+    for source_track in source_tracks:
+      for collection in collections:
+        if not collection.target.query.matches(key=source_track.key, mode=source_track.mode, tempo=source_track.tempo):
+          continue
+        if collection.check_already_compiled(source_track):
+          continue
+        if source_track.id in collection.final_track_ids:
+          continue
+        if sql_collection_track := collection.known_tracks.get(source_track.id):
+          if sql_collection_track.id in collection.collection_track_ids:
+            collection.add_final_track(sql_collection_track)
+          continue
+        collection.add_final_track(source_track)
+        self.sql.add_track(track_id=source_track.id, collection_id=collection.collection_playlist_id)
+        collection.add_known_track(source_track)
+
+  def __prepare_page(self, playlist_tracks: list[SpotifyTrack], collections: list[CollectionState]) -> PendingPage:
+    page_tracks: list[SpotifyTrack] = []
+    collection_tracks: list[tuple[CollectionState, SpotifyTrack, SQLTrack | None]] = []
+    for playlist_track in playlist_tracks:
+      is_pending = False
+      for collection in collections:
+        if collection.check_already_compiled(playlist_track):
+          continue
+        sql_collection_track = collection.known_tracks.get(playlist_track.id)
         if sql_collection_track:
-          if sql_collection_track not in collection_playlist_tracks:
+          if sql_collection_track.id not in collection.collection_track_ids:
+            continue
+          if sql_collection_track.id in collection.final_track_ids:
             continue
-          final_tracks.append(sql_collection_track)
-        self.set_track_analytics(playlist_track)
-        if playlist_track.matches(key=key.id, mode=mode.id):
-          if playlist_track not in final_tracks:
-            final_tracks.append(playlist_track)
-          if not sql_collection_track:
-            self.sql.add_track(track_id=playlist_track.id, collection_id=collection_playlist_id, tempo=playlist_track.tempo)
-
-  def check_for_new_collection_tracks(
-      self,
-      *,
-      collection_playlist_id: str,
-      collection_playlist_tracks: list[SpotifyTrack],
-      final_tracks: SharedTrackList
-    ) -> None:
-      for collection_track in collection_playlist_tracks:
-        if collection_track not in final_tracks:
-          self.set_track_analytics(collection_track)
-          final_tracks.append(collection_track)
-          sql_collection_track = self.sql.get_track_by_collection(track_id=collection_track.id, collection_id=collection_playlist_id)
-          if not sql_collection_track:
-            self.sql.add_track(track_id=collection_track.id, collection_id=collection_playlist_id, tempo=collection_track.tempo)
-
-  def clear_current_collection(self, *, collection_playlist_id: str, collection_playlist_tracks: SharedTrackList) -> None:
-      for chunk in chunk_list(collection_playlist_tracks, 100):
-        track_ids = [track.id for track in chunk]
-        self.spotify.delete_playlist_tracks(playlist_id=collection_playlist_id, track_ids=track_ids)
-
-  def add_final_tracks_to_collection(self, *,  collection_playlist_id: str, final_tracks: SharedTrackList) -> None:
-    final_tracks.sort(key=lambda x: x.tempo)
-    for chunk in chunk_list(final_tracks, 100):
-      track_ids = [track.id for track in chunk]
-      self.spotify.add_playlist_tracks(playlist_id=collection_playlist_id, track_ids=track_ids)
+          collection.add_final_track(sql_collection_track)
+        collection_tracks.append((collection, playlist_track, sql_collection_track))
+        is_pending = True
+      if is_pending:
+        page_tracks.append(playlist_track)
+    missing_tracks = self.__set_cached_tracks_analytics(page_tracks)
+    return PendingPage(
+      collection_tracks=collection_tracks,
+      missing_tracks=missing_tracks,
+      analytics_futures=self.__fetch_tracks_analytics(missing_tracks)
+    )
+
+  def __route_page(self, page: PendingPage) -> None:
+    self.__store_fetched_tracks_analytics(page.missing_tracks, page.analytics_futures)
+    for collection, playlist_track, sql_collection_track in page.collection_tracks:
+      is_match = collection.target.query.matches(key=playlist_track.key, mode=playlist_track.mode, tempo=playlist_track.tempo)
+      if is_match and playlist_track.id not in collection.final_track_ids:
+        collection.add_final_track(playlist_track)
+        if not sql_collection_track:
+          self.sql.add_track(track_id=playlist_track.id, collection_id=collection.collection_playlist_id)
+          collection.add_known_track(playlist_track)
+
+  @metrics.timed('handler.check_for_new_collection_tracks')
+  def check_for_new_collection_tracks(self, *, collection: CollectionState) -> None:
+      new_collection_tracks: dict[str, SpotifyTrack] = {}
+      for collection_track in collection.collection_playlist_tracks:
+        if collection_track and collection_track.id not in collection.final_track_ids:
+          new_collection_tracks.setdefault(collection_track.id, collection_track)
+      self.set_tracks_analytics(list(new_collection_tracks.values()))
+      for collection_track in new_collection_tracks.values():
+        collection.add_final_track(collection_track)
+        if collection_track.id not in collection.known_tracks:
+          self.sql.add_track(track_id=collection_track.id, collection_id=collection.collection_playlist_id)
+          collection.add_known_track(collection_track)
+
+  @metrics.timed('handler.sync_collection')
+  def sync_collection(self, *, collection: CollectionState) -> str | None:
+    collection_playlist_id = collection.collection_playlist_id
+    plan = plan_sync(
+      [track.id if track else None for track in collection.collection_playlist_tracks],
+      collection.final_tracks.get_ids_by_tempo()
+    )
+    responses: list[dict | None] = []
+    if plan.is_empty:
+      return None
+    if plan.replace_track_ids is not None:
+      [first_chunk, *chunks] = list(chunk_list(plan.replace_track_ids, 100)) or [[]]
+      responses.append(self.spotify.replace_playlist_tracks(playlist_id=collection_playlist_id, track_ids=first_chunk))
+      for chunk in chunks:
+        responses.append(self.spotify.add_playlist_tracks(playlist_id=collection_playlist_id, track_ids=chunk))
+      return self.__get_last_snapshot_id(responses)
+    for chunk in chunk_list(plan.remove_track_ids, 100):
+      responses.append(self.spotify.delete_playlist_tracks(playlist_id=collection_playlist_id, track_ids=chunk))
+    for move in plan.moves:
+      responses.append(self.spotify.reorder_playlist_tracks(playlist_id=collection_playlist_id, range_start=move.range_start, insert_before=move.insert_before))
+    for insert in plan.inserts:
+      responses.append(self.spotify.add_playlist_tracks(playlist_id=collection_playlist_id, track_ids=insert.track_ids, position=insert.position))
+    return self.__get_last_snapshot_id(responses)
+
+  def __get_last_snapshot_id(self, responses: list[dict | None]) -> str | None:
+    response = responses[-1] if responses else None
+    return response.get('snapshot_id') if type(response) is dict else None
@@ -0,0 +1,102 @@
+import os
+import json
+import threading
+from time import perf_counter
+from functools import wraps
+from bisect import bisect_left
+from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Generator
+
+from utils.vars import DATA_DIRPATH
+
+REPORTS_DIRPATH = f'{DATA_DIRPATH}/reports'
+# upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+@dataclass
+class TimerStats:
+  count: int = 0
+  total_ms: float = 0
+  min_ms: float | None = None
+  max_ms: float = 0
+  histogram: list[int] = field(default_factory=lambda: [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+
+  def observe(self, ms: float) -> None:
+    self.count += 1
+    self.total_ms += ms
+    self.min_ms = ms if self.min_ms is None else min(self.min_ms, ms)
+    self.max_ms = max(self.max_ms, ms)
+    self.histogram[bisect_left(HISTOGRAM_BUCKETS_MS, ms)] += 1
+
+  def to_dict(self) -> dict:
+    labels = [f'<={bound}ms' for bound in HISTOGRAM_BUCKETS_MS] + [f'>{HISTOGRAM_BUCKETS_MS[-1]}ms']
+    return {
+      'count': self.count,
+      'total_ms': round(self.total_ms, 3),
+      'mean_ms': round(self.total_ms / self.count, 3) if self.count else None,
+      'min_ms': round(self.min_ms, 3) if self.min_ms is not None else None,
+      'max_ms': round(self.max_ms, 3),
+      'histogram': {label: n for label, n in zip(labels, self.histogram) if n}
+    }
+
+
+@dataclass
+class Metrics:
+  started_at: datetime = field(default_factory=datetime.now)
+  counters: dict[str, int] = field(default_factory=dict)
+  timers: dict[str, TimerStats] = field(default_factory=dict)
+  lock: threading.Lock = field(default_factory=threading.Lock)
+
+  def count(self, name: str, value: int = 1) -> None:
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def observe(self, name: str, seconds: float) -> None:
+    with self.lock:
+      self.timers.setdefault(name, TimerStats()).observe(seconds * 1000)
+
+  @contextmanager
+  def timer(self, name: str) -> Generator[None, None, None]:
+    started_at = perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, perf_counter() - started_at)
+
+  def timed(self, name: str) -> Callable:
+    def decorator(func):
+      @wraps(func)
+      def inner(*args, **kwargs):
+        with self.timer(name):
+          return func(*args, **kwargs)
+      return inner
+    return decorator
+
+  def reset(self) -> None:
+    with self.lock:
+      self.started_at = datetime.now()
+      self.counters.clear()
+      self.timers.clear()
+
+  def get_report(self, **extra) -> dict:
+    with self.lock:
+      return {
+        'started_at': self.started_at.isoformat(),
+        'duration_seconds': round((datetime.now() - self.started_at).total_seconds(), 3),
+        'counters': dict(sorted(self.counters.items())),
+        'timers': {name: stats.to_dict() for name, stats in sorted(self.timers.items())},
+        **extra
+      }
+
+  def write_report(self, dirpath: str = REPORTS_DIRPATH, **extra) -> str:
+    os.makedirs(dirpath, exist_ok=True)
+    filepath = f'{dirpath}/report-{self.started_at.strftime("%Y%m%d-%H%M%S")}.json'
+    with open(filepath, mode='w', encoding='utf8') as f:
+      json.dump(self.get_report(**extra), f, indent=2)
+    return filepath
+
+
+metrics = Metrics()
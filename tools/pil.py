@@ -1,23 +1,40 @@
 import io
+import os
 import base64
+import hashlib
+import threading
+from functools import lru_cache
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import requests
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import Image as ImageType
 
-from utils.vars import FONTS_PATH
+from tools.metrics import metrics
+from utils.vars import DATA_DIRPATH, FONTS_PATH
 
 SPOTIFY_FONT = f'{FONTS_PATH}/GothamMedium.ttf'
+COVER_CACHE_DIRPATH = f'{DATA_DIRPATH}/covers'
+SOURCE_CACHE_DIRPATH = f'{COVER_CACHE_DIRPATH}/sources'
+COVER_MAX_BASE64_BYTES = 256 * 1024
+COVER_MAX_QUALITY = 95
+COVER_MIN_QUALITY = 20
+REQUEST_TIMEOUT = 30
 
 
+@lru_cache(maxsize=None)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+  return ImageFont.truetype(SPOTIFY_FONT, size)
+
 def get_image_from_url(img_url: str | None):
   if img_url:
-    img_bytes = requests.get(img_url).content
+    img_bytes = _get_source_image_bytes(img_url)
     return Image.open(io.BytesIO(img_bytes))
   return Image.new('RGB', (500, 500), (0, 0, 0))
 
 def format_collection_cover(img_url: str | None, text_key: str, text_mode: str):
-  img = get_image_from_url(img_url)
+  img = get_image_from_url(img_url).convert('RGB')
 
   black = Image.new('RGB', img.size, (0, 0, 0))
   mask = Image.new('RGBA', img.size, (0, 0, 0, 42))
@@ -27,11 +44,11 @@ def format_collection_cover(img_url: str | None, text_key: str, text_mode: str):
   draw = ImageDraw.Draw(img_edited)
 
   fillH1 = (255, 255, 255)
-  fontH1 = ImageFont.truetype(SPOTIFY_FONT, int(img_edited.width * 0.50))
+  fontH1 = get_font(int(img_edited.width * 0.50))
   _, _, fontWidthA, fontHeightA = draw.textbbox((0, 0), text_key, font=fontH1)
 
   fillH4 = (177, 179, 181)
-  fontH4 = ImageFont.truetype(SPOTIFY_FONT, int(img_edited.width * 0.13))
+  fontH4 = get_font(int(img_edited.width * 0.13))
   _, _, fontWidthB, fontHeightB = draw.textbbox((0, 0), text_mode, font=fontH4)
 
   xyH1 = ((img_edited.width-fontWidthA)/2, (img_edited.height-fontHeightA)/2 - fontHeightB)
@@ -42,13 +59,106 @@ def format_collection_cover(img_url: str | None, text_key: str, text_mode: str):
 
   return img_edited
 
-def base64_encode_image(image: ImageType) -> bytes:  
-  buffered = io.BytesIO()
-  image.save(buffered, format='JPEG')
-  img_bytes = base64.b64encode(buffered.getvalue())
-  return img_bytes
+def base64_encode_image(image: ImageType, max_bytes: int = COVER_MAX_BASE64_BYTES) -> bytes:
+  # binary search for the highest quality that still fits the upload limit
+  low, high = COVER_MIN_QUALITY, COVER_MAX_QUALITY
+  best = None
+  while low <= high:
+    quality = (low + high) // 2
+    img_bytes = _encode_jpeg(image, quality)
+    if len(img_bytes) <= max_bytes:
+      best = img_bytes
+      low = quality + 1
+    else:
+      high = quality - 1
+  if best is None:
+    # even the lowest quality is too big, so shrink the image and try again
+    smaller = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+    return base64_encode_image(smaller, max_bytes)
+  return best
 
 def get_encoded_cover(*, img_url: str | None, text_key: str, text_mode: str) -> bytes:
-  img = format_collection_cover(img_url, text_key, text_mode)
-  base64_img = base64_encode_image(img)
+  cache_filepath = _get_cover_cache_filepath(img_url, text_key, text_mode)
+  if cached := _read_file(cache_filepath):
+    metrics.count('covers.cache_hits')
+    return cached
+  with metrics.timer('covers.render'):
+    img = format_collection_cover(img_url, text_key, text_mode)
+    base64_img = base64_encode_image(img)
+  _write_file(cache_filepath, base64_img)
   return base64_img
+
+def check_cover_cached(*, img_url: str | None, text_key: str, text_mode: str) -> bool:
+  return os.path.exists(_get_cover_cache_filepath(img_url, text_key, text_mode))
+
+def _get_cover_cache_filepath(img_url: str | None, text_key: str, text_mode: str) -> str:
+  return f'{COVER_CACHE_DIRPATH}/{_get_cache_key(img_url or "", text_key, text_mode)}.b64'
+
+def _encode_jpeg(image: ImageType, quality: int) -> bytes:
+  buffered = io.BytesIO()
+  image.save(buffered, format='JPEG', quality=quality, optimize=True)
+  return base64.b64encode(buffered.getvalue())
+
+def _get_source_image_bytes(img_url: str) -> bytes:
+  # spotify image urls are content-addressed, so a url never points at a different image
+  cache_filepath = f'{SOURCE_CACHE_DIRPATH}/{_get_cache_key(img_url)}'
+  if cached := _read_file(cache_filepath):
+    return cached
+  res = requests.get(img_url, timeout=REQUEST_TIMEOUT)
+  res.raise_for_status()
+  _write_file(cache_filepath, res.content)
+  return res.content
+
+def _get_cache_key(*parts: str) -> str:
+  return hashlib.sha1('\0'.join(parts).encode('utf8')).hexdigest()
+
+def _read_file(filepath: str) -> bytes | None:
+  try:
+    with open(filepath, mode='rb') as f:
+      return f.read() or None
+  except OSError:
+    return None
+
+def _write_file(filepath: str, content: bytes) -> None:
+  os.makedirs(os.path.dirname(filepath), exist_ok=True)
+  tmp_filepath = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmp_filepath, mode='wb') as f:
+    f.write(content)
+  os.replace(tmp_filepath, filepath)
+
+
+@dataclass
+class CoverRenderer:
+  processes: int = 1
+  executor: ProcessPoolExecutor | None = field(init=False, default=None)
+  futures: dict[tuple[str | None, str, str], Future] = field(init=False, default_factory=dict)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+
+  def submit(self, *, img_url: str | None, text_key: str, text_mode: str) -> None:
+    cover_key = (img_url, text_key, text_mode)
+    if self.processes < 1 or cover_key in self.futures or check_cover_cached(img_url=img_url, text_key=text_key, text_mode=text_mode):
+      return
+    if not self.executor:
+      self.executor = ProcessPoolExecutor(max_workers=self.processes)
+    self.futures[cover_key] = self.executor.submit(get_encoded_cover, img_url=img_url, text_key=text_key, text_mode=text_mode)
+
+  def get(self, *, img_url: str | None, text_key: str, text_mode: str) -> bytes:
+    future = self.futures.pop((img_url, text_key, text_mode), None)
+    if future:
+      try:
+        with metrics.timer('covers.prerender_wait'):
+          return future.result()
+      except Exception as e:
+        print(f'⚠️  Pre-rendering the {text_key} {text_mode} cover failed, rendering it again: {e}')
+    return get_encoded_cover(img_url=img_url, text_key=text_key, text_mode=text_mode)
+
+  def shutdown(self) -> None:
+    if self.executor:
+      self.executor.shutdown(cancel_futures=True)
+      self.executor = None
+    self.futures.clear()
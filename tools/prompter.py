@@ -1,23 +1,43 @@
 import re
+import json
+import time
 import inquirer
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor
 
 from tools.spotify import SpotifyAPI, SpotifyPlaylist
 from tools.db import SQLite, SQLKeyMode
+from tools.handler import CollectionTarget
 
 from utils.vars import DATA_DIRPATH
 
 PLAYLIST_IDS_FP = f'{DATA_DIRPATH}/playlist_ids.txt'
+PLAYLIST_METADATA_FP = f'{DATA_DIRPATH}/playlist_metadata.json'
+PLAYLIST_METADATA_TTL = 10 * 60
+PLAYLIST_METADATA_WORKERS = 8
+TARGET_CHOICES = {
+  'single': 'A single key & mode',
+  'multiple': 'Several keys & modes',
+  'all': 'All 24 keys & modes'
+}
+NEIGHBOR_CHOICES = {
+  'exact': 'Only the key & mode itself',
+  'relative': 'Also its relative major / minor',
+  'camelot': 'Also its neighbours on the Camelot wheel'
+}
+TEMPO_RANGE_PATTERN = r'^\s*(\d+(?:\.\d+)?)?\s*-\s*(\d+(?:\.\d+)?)?\s*$'
 
 class Prompter:
   @classmethod
-  def get_key_and_mode(cls, sql: SQLite) -> tuple[SQLKeyMode, SQLKeyMode]:
-    key = cls.__get_key(sql)
-    mode = cls.__get_mode(sql)
-    return key, mode
+  def get_key_and_mode(cls, sql: SQLite) -> list[CollectionTarget]:
+    targets = cls.__get_targets(sql)
+    neighbors = cls.__get_neighbors()
+    min_tempo, max_tempo = cls.__get_tempo_range()
+    return [replace(target, neighbors=neighbors, min_tempo=min_tempo, max_tempo=max_tempo) for target in targets]
   
   @classmethod
   def get_playlists(cls, spotify: SpotifyAPI) -> list[SpotifyPlaylist]:
-    playlist_ids = cls.__read_playlist_ids()
+    playlist_ids = cls.read_playlist_ids()
     cls.assert_found_playlist_ids(playlist_ids)
     playlists = cls.__get_multiple_playlists(spotify, playlist_ids)
     playlists = cls.__filter_selected_playlists(playlists)
@@ -28,6 +48,40 @@ class Prompter:
     condition = len(playlist_ids) > 0 and playlist_ids != ['']
     assert condition, f'No playlist IDs found in {PLAYLIST_IDS_FP}. Quitting...'
 
+  @classmethod
+  def __get_targets(cls, sql: SQLite) -> list[CollectionTarget]:
+    choice = cls.__get_target_choice()
+    if choice == TARGET_CHOICES['all']:
+      return cls.__get_all_targets(sql)
+    if choice == TARGET_CHOICES['multiple']:
+      return cls.__get_multiple_targets(sql)
+    key = cls.__get_key(sql)
+    mode = cls.__get_mode(sql)
+    return [CollectionTarget(key, mode)]
+
+  @classmethod
+  def __get_target_choice(cls) -> str:
+    return inquirer.list_input(
+      'What would you like to collect?',
+      choices=list(TARGET_CHOICES.values()),
+      carousel=True
+    )
+
+  @classmethod
+  def __get_all_targets(cls, sql: SQLite) -> list[CollectionTarget]:
+    keys = sql.get_all_keys()
+    modes = list(reversed(sql.get_all_modes()))
+    return [CollectionTarget(key, mode) for mode in modes for key in keys]
+
+  @classmethod
+  def __get_multiple_targets(cls, sql: SQLite) -> list[CollectionTarget]:
+    return inquirer.checkbox(
+      'Which keys & modes would you like to collect? (tick using whitespace)',
+      choices=cls.__get_all_targets(sql),
+      carousel=True,
+      validate=lambda _, targets: len(targets) > 0
+    )
+
   @classmethod
   def __get_key(cls, sql: SQLite) -> SQLKeyMode:
     keys = sql.get_all_keys()
@@ -47,19 +101,68 @@ class Prompter:
     )
 
   @classmethod
-  def __read_playlist_ids(cls) -> list[str]:
+  def __get_neighbors(cls) -> str:
+    choice = inquirer.list_input(
+      'Which tracks around each key & mode would you like to collect?',
+      choices=list(NEIGHBOR_CHOICES.values()),
+      carousel=True
+    )
+    return next(neighbors for neighbors, label in NEIGHBOR_CHOICES.items() if label == choice)
+
+  @classmethod
+  def __get_tempo_range(cls) -> tuple[float | None, float | None]:
+    answer = inquirer.text(
+      'Which tempo range would you like to collect? (e.g. 90-120 or 140-, leave empty for any)',
+      validate=lambda _, answer: not answer.strip() or re.match(TEMPO_RANGE_PATTERN, answer) is not None
+    )
+    if not answer.strip():
+      return None, None
+    min_tempo, max_tempo = re.match(TEMPO_RANGE_PATTERN, answer).groups()
+    return (
+      float(min_tempo) if min_tempo else None,
+      float(max_tempo) if max_tempo else None
+    )
+
+  @classmethod
+  def read_playlist_ids(cls) -> list[str]:
     with open(PLAYLIST_IDS_FP, mode='r', encoding='utf8') as f:
       lines = re.split(r'\n+', f.read().strip())
       return list(set(lines))
     
   @classmethod
   def __get_multiple_playlists(cls, spotify: SpotifyAPI, ids: list[str]) -> list[SpotifyPlaylist]:
+    cached = cls.__read_playlist_metadata()
+    now = time.time()
+    missing_ids = [playlist_id for playlist_id in ids if now - cached.get(playlist_id, {}).get('cached_at', 0) > PLAYLIST_METADATA_TTL]
+    with ThreadPoolExecutor(max_workers=PLAYLIST_METADATA_WORKERS) as executor:
+      for playlist_id, playlist in zip(missing_ids, executor.map(spotify.get_playlist_metadata, missing_ids)):
+        if playlist:
+          cached[playlist_id] = { 'id': playlist.id, 'name': playlist.name, 'cover': playlist.cover, 'cached_at': now }
+        else:
+          cached.pop(playlist_id, None)
+    if missing_ids:
+      cls.__write_playlist_metadata(cached)
     playlists = []
     for playlist_id in ids:
-      if playlist := spotify.get_playlist(playlist_id):
+      if metadata := cached.get(playlist_id):
+        playlist = SpotifyPlaylist(id=metadata['id'], name=metadata['name'], images=None)
+        playlist.cover = metadata['cover']
         playlists.append(playlist)
     return playlists
 
+  @classmethod
+  def __read_playlist_metadata(cls) -> dict[str, dict]:
+    try:
+      with open(PLAYLIST_METADATA_FP, mode='r', encoding='utf8') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return {}
+
+  @classmethod
+  def __write_playlist_metadata(cls, metadata: dict[str, dict]) -> None:
+    with open(PLAYLIST_METADATA_FP, mode='w', encoding='utf8') as f:
+      json.dump(metadata, f)
+
   @classmethod
   def __filter_selected_playlists(cls, playlists: list[SpotifyPlaylist]) -> list[SpotifyPlaylist]:
     return inquirer.checkbox(
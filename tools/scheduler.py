@@ -0,0 +1,206 @@
+import json
+import time
+from math import ceil
+from datetime import datetime, timezone
+from dataclasses import dataclass, field, asdict
+
+from tools.spotify import SpotifyAPI, SpotifyPlaylist, PLAYLIST_STATUS_FIELDS
+from tools.db import SQLite, TRACK_NEIGHBORS
+from tools.handler import SpotifySQLHandler, CollectionTarget
+from tools.prompter import Prompter
+from tools.metrics import metrics
+
+from utils.vars import DATA_DIRPATH
+
+SCHEDULER_CONFIG_FP = f'{DATA_DIRPATH}/scheduler.json'
+SCHEDULER_SUMMARY_FP = f'{DATA_DIRPATH}/scheduler_summary.jsonl'
+PAGE_SIZE = 100
+# collection snapshot check, first-page listing and final sync for each target
+REQUESTS_PER_TARGET = 3
+
+
+@dataclass
+class SchedulerConfig:
+  playlists: list[str] = field(default_factory=list)
+  targets: str | list[dict[str, str | float]] = 'all'
+  interval_minutes: float = 60
+  request_budget: int | None = None
+  requests_per_second: float | None = None
+  workers: int = 1
+  page_window: int = 1
+  http_cache_mb: int = 0
+  cover_processes: int = 1
+  summary_path: str = SCHEDULER_SUMMARY_FP
+
+  @classmethod
+  def from_file(cls, filepath: str = SCHEDULER_CONFIG_FP) -> 'SchedulerConfig':
+    with open(filepath, mode='r', encoding='utf8') as f:
+      data = json.load(f)
+    unknown = set(data) - set(cls.__dataclass_fields__)
+    assert not unknown, f'Unknown scheduler settings in {filepath}: {", ".join(sorted(unknown))}'
+    cls.__validate_targets(data.get('targets', 'all'), filepath)
+    return cls(**data)
+
+  @classmethod
+  def __validate_targets(cls, targets, filepath: str) -> None:
+    if isinstance(targets, str):
+      assert targets == 'all', f'Invalid targets in {filepath}: expected "all" or a list of keys & modes, got {targets!r}'
+      return
+    assert isinstance(targets, list) and targets, f'Invalid targets in {filepath}: expected "all" or a list of keys & modes, got {targets!r}'
+    for target in targets:
+      is_valid = isinstance(target, dict) and isinstance(target.get('key'), str) and isinstance(target.get('mode'), str)
+      assert is_valid, f'Invalid target in {filepath}: expected an object with a "key" and a "mode", got {target!r}'
+
+@dataclass
+class PlaylistStatus:
+  playlist: SpotifyPlaylist
+  stale_targets: int
+  track_delta: int
+
+  @property
+  def priority(self) -> tuple[int, int]:
+    return (self.stale_targets, self.track_delta)
+
+@dataclass
+class CycleSummary:
+  cycle: int
+  started_at: str
+  duration_seconds: float = 0
+  requests: int = 0
+  request_budget: int | None = None
+  synced: list[str] = field(default_factory=list)
+  unchanged: list[str] = field(default_factory=list)
+  deferred: list[str] = field(default_factory=list)
+  failed: list[dict[str, str]] = field(default_factory=list)
+  error: str | None = None
+  report_path: str | None = None
+
+
+class Scheduler:
+  config: SchedulerConfig
+  spotify: SpotifyAPI
+  sql: SQLite
+  handler: SpotifySQLHandler
+  targets: list[CollectionTarget]
+  track_totals: dict[str, int]
+  cycle: int
+
+  def __init__(self, *, config: SchedulerConfig, spotify: SpotifyAPI, sql: SQLite, handler: SpotifySQLHandler):
+    self.config = config
+    self.spotify = spotify
+    self.sql = sql
+    self.handler = handler
+    self.targets = self.__get_targets()
+    self.track_totals = {}
+    self.cycle = 0
+
+  def run_forever(self) -> None:
+    while True:
+      started_at = time.monotonic()
+      try:
+        self.run_cycle()
+      except Exception as e:
+        # an unattended daemon outlives a bad cycle, the next one starts on schedule
+        print(f'❌ Cycle {self.cycle} failed: {e!r}')
+      next_cycle_in = self.config.interval_minutes * 60 - (time.monotonic() - started_at)
+      if next_cycle_in > 0:
+        print(f'💤 Next cycle in {next_cycle_in / 60:.1f} minutes')
+        time.sleep(next_cycle_in)
+
+  def run_cycle(self) -> CycleSummary:
+    self.cycle += 1
+    summary = CycleSummary(cycle=self.cycle, started_at=datetime.now(timezone.utc).isoformat(), request_budget=self.config.request_budget)
+    started_at = time.monotonic()
+    requests_at_start = self.spotify.rate_limiter.request_count
+    metrics.reset()
+    print(f'🔁 Cycle {self.cycle} started')
+
+    try:
+      self.handler.reconcile_collections()
+      statuses = sorted(self.__get_playlist_statuses(summary), key=lambda status: status.priority, reverse=True)
+    except Exception as e:
+      print(f'❌ Cycle {self.cycle} failed before compiling: {e}')
+      summary.error = repr(e)
+      return self.__finish_cycle(summary, started_at, requests_at_start)
+    self.handler.prerender_covers(targets=self.targets, playlists=[status.playlist for status in statuses if status.stale_targets])
+    for i, status in enumerate(statuses):
+      playlist = status.playlist
+      spent = self.spotify.rate_limiter.request_count - requests_at_start
+      # always compile at least one playlist so an undersized budget can't stall the daemon
+      if i and not self.__check_within_budget(spent, status):
+        summary.deferred.append(playlist.id)
+        continue
+      try:
+        changed = self.handler.compile_playlist(targets=self.targets, playlist=playlist)
+      except Exception as e:
+        print(f'❌ Failed to compile "{playlist}": {e}')
+        summary.failed.append({ 'playlist': playlist.id, 'error': repr(e) })
+        continue
+      (summary.synced if changed else summary.unchanged).append(playlist.id)
+      if playlist.total_tracks is not None:
+        self.track_totals[playlist.id] = playlist.total_tracks
+    return self.__finish_cycle(summary, started_at, requests_at_start)
+
+  def __finish_cycle(self, summary: CycleSummary, started_at: float, requests_at_start: int) -> CycleSummary:
+    summary.requests = self.spotify.rate_limiter.request_count - requests_at_start
+    summary.duration_seconds = round(time.monotonic() - started_at, 3)
+    summary.report_path = metrics.write_report(cycle=self.cycle)
+    self.__write_summary(summary)
+    print(f'{"⚠️ " if summary.error else "✅"} Cycle {self.cycle}: {len(summary.synced)} synced, {len(summary.unchanged)} unchanged, {len(summary.deferred)} deferred, {len(summary.failed)} failed, {summary.requests} requests')
+    return summary
+
+  def __get_targets(self) -> list[CollectionTarget]:
+    keys = self.sql.get_all_keys()
+    modes = list(reversed(self.sql.get_all_modes()))
+    if self.config.targets == 'all':
+      return [CollectionTarget(key, mode) for mode in modes for key in keys]
+    keys_by_name = {key.name: key for key in keys}
+    modes_by_name = {mode.name.lower(): mode for mode in modes}
+    targets = []
+    for target in self.config.targets:
+      key, mode = keys_by_name.get(target['key']), modes_by_name.get(target['mode'].lower())
+      assert key and mode, f'Unknown key & mode in scheduler config: {target}'
+      neighbors = target.get('neighbors', 'exact')
+      assert neighbors in TRACK_NEIGHBORS, f'Unknown neighbors in scheduler config: {target}, expected one of {", ".join(TRACK_NEIGHBORS)}'
+      targets.append(CollectionTarget(key, mode, neighbors, target.get('min_tempo'), target.get('max_tempo')))
+    return targets
+
+  def __get_playlist_statuses(self, summary: CycleSummary) -> list[PlaylistStatus]:
+    playlist_ids = self.config.playlists or Prompter.read_playlist_ids()
+    statuses = []
+    for playlist_id in playlist_ids:
+      try:
+        playlist = self.spotify.get_playlist_metadata(playlist_id, fields=PLAYLIST_STATUS_FIELDS)
+      except Exception as e:
+        print(f'❌ Failed to fetch playlist {playlist_id}: {e}')
+        summary.failed.append({ 'playlist': playlist_id, 'error': repr(e) })
+        continue
+      if not playlist:
+        print(f'⚠️  Playlist {playlist_id} was not found')
+        continue
+      statuses.append(PlaylistStatus(
+        playlist=playlist,
+        stale_targets=self.__count_stale_targets(playlist),
+        track_delta=abs((playlist.total_tracks or 0) - self.track_totals.get(playlist.id, 0))
+      ))
+    return statuses
+
+  def __count_stale_targets(self, playlist: SpotifyPlaylist) -> int:
+    stale_targets = 0
+    for target in self.targets:
+      sql_collection = self.sql.get_collection_by_data(playlist_id=playlist.id, key=target.key.id, mode=target.mode.id, track_filter=target.track_filter)
+      if not sql_collection or playlist.snapshot_id is None or sql_collection.source_snapshot_id != playlist.snapshot_id:
+        stale_targets += 1
+    return stale_targets
+
+  def __check_within_budget(self, spent: int, status: PlaylistStatus) -> bool:
+    if self.config.request_budget is None:
+      return True
+    pages = max(ceil((status.playlist.total_tracks or 0) / PAGE_SIZE), 1)
+    # every page is listed once and may need one audio-features call
+    estimate = pages * 2 + len(self.targets) * REQUESTS_PER_TARGET
+    return spent + estimate <= self.config.request_budget
+
+  def __write_summary(self, summary: CycleSummary) -> None:
+    with open(self.config.summary_path, mode='a', encoding='utf8') as f:
+      f.write(json.dumps(asdict(summary)) + '\n')
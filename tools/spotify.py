@@ -1,17 +1,29 @@
 import os
+import re
+import sys
 import json
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from time import sleep, monotonic
 from functools import wraps
 from dataclasses import dataclass, field, InitVar
-from typing import Generator, Literal, TypeAlias
+from typing import AsyncGenerator, Generator, Literal, TypeAlias
 
 from base64 import b64encode
 import urllib.parse as urlparse
 from urllib.parse import urlencode
 from selenium import webdriver
 
+from tools.cache import HTTPCache
+from tools.metrics import metrics
 from utils.vars import DATA_DIRPATH
+from utils.misc import chunk_list
 
 
 BASE_URLS = {
@@ -19,18 +31,35 @@ BASE_URLS = {
   'auth': 'https://accounts.spotify.com'
 }
 SCOPES = [
+  'playlist-read-private',
   'playlist-modify-public',
   'playlist-modify-private',
   'ugc-image-upload'
 ]
 REFRESH_TOKEN_FP = f'{DATA_DIRPATH}/refresh_token.txt'
+REQUEST_TIMEOUT = 30
+# access tokens are refreshed this many seconds before they actually expire
+TOKEN_REFRESH_MARGIN = 60
+PLAYLIST_METADATA_FIELDS = 'id,name,images'
+# metadata plus what's needed to tell whether a playlist changed, without its first page of tracks
+PLAYLIST_STATUS_FIELDS = 'id,name,images,snapshot_id,tracks.total'
+FOLLOWED_PLAYLISTS_PARAMS = { 'limit': 50 }
+# only listings come back unchanged often enough to answer with a 304, one-off batches like /audio-features would crowd them out
+HTTP_CACHE_ENDPOINT_PATTERN = re.compile(r'^/(me/playlists|playlists/[^/]+(/tracks)?)$')
+PLAYLIST_TRACKS_PARAMS = {
+  'fields': 'next,total,limit,offset,items(added_at,is_local,track(type,id,name,artists(name)))',
+  'limit': 100
+}
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30
 
 
-@dataclass
+@dataclass(slots=True)
 class SpotifyTrack:
-  id: str = field(hash=True)
+  id: str
   name: str
   artist: str
+  added_at: str | None = field(default=None)
   key: int = field(init=False, default=None)
   mode: int = field(init=False, default=None)
   tempo: float = field(init=False, default=None)
@@ -48,6 +77,10 @@ class SpotifyTrack:
       return self.id == other.id
     if isinstance(other, str):
       return self.id == other
+    return NotImplemented
+
+  def __hash__(self) -> int:
+    return hash(self.id)
 
 @dataclass
 class SpotifyPlaylist:
@@ -55,6 +88,8 @@ class SpotifyPlaylist:
   name: str
   cover: str | None = field(init=False, default=None)
   images: InitVar[list[dict[str, str]] | None]
+  snapshot_id: str | None = field(default=None)
+  total_tracks: int | None = field(default=None)
 
   def __post_init__(self, images):
     if images:
@@ -65,53 +100,241 @@ class SpotifyPlaylist:
 
 BaseUrlTarget: TypeAlias = Literal['api', 'auth']
 
+
+def _instantiate_playlist(data: dict) -> SpotifyPlaylist:
+  _id = data['id']
+  _name = data['name']
+  _images = data['images']
+  _snapshot_id = data.get('snapshot_id')
+  _total_tracks = (data.get('tracks') or {}).get('total')
+  return SpotifyPlaylist(
+    id=_id,
+    name=_name,
+    images=_images,
+    snapshot_id=_snapshot_id,
+    total_tracks=_total_tracks
+  )
+
+def _instantiate_track(data: dict) -> SpotifyTrack:
+  _data_track = data.get('track', data)
+  _id = _data_track['id']
+  _name = _data_track['name']
+  # the same artists and batch timestamps repeat across big libraries, so share one string each
+  _artist = sys.intern(', '.join(artist['name'] for artist in _data_track['artists']))
+  _added_at = data.get('added_at')
+  _added_at = sys.intern(_added_at) if _added_at else _added_at
+  return SpotifyTrack(
+    id=_id,
+    name=_name,
+    artist=_artist,
+    added_at=_added_at
+  )
+
+def _check_track_item(data: dict | None) -> bool:
+  # removed tracks come back as null, local files have no id and podcast episodes have no artists
+  if not data or data.get('is_local'):
+    return False
+  _data_track = data.get('track')
+  return bool(_data_track and _data_track.get('id') and _data_track.get('type', 'track') == 'track')
+
+def _get_next_page(next_url: str | None, params: dict) -> tuple[str | None, dict]:
+  if not next_url:
+    return None, params
+  parsed_url = urlparse.urlparse(next_url.replace(BASE_URLS['api'], ''))
+  # the next link carries the offset, our params keep the projection if the link drops it
+  return parsed_url.path, {**params, **dict(urlparse.parse_qsl(parsed_url.query))}
+
+def _get_remaining_offsets(result: dict) -> range | None:
+  total, limit, offset = result.get('total'), result.get('limit'), result.get('offset')
+  if total is None or not limit or offset is None:
+    return None
+  return range(offset + limit, total, limit)
+
+def _set_track_analytics(track: SpotifyTrack, analytics: dict) -> None:
+  track.set_analytics(
+    key = analytics['track']['key'],
+    mode = analytics['track']['mode'],
+    tempo = analytics['track']['tempo']
+  )
+
+def _set_track_features(track: SpotifyTrack, features: dict) -> None:
+  track.set_analytics(
+    key = features['key'],
+    mode = features['mode'],
+    tempo = features['tempo']
+  )
+
+def _check_idempotent(method: str, data) -> bool:
+  # a reorder moves tracks relative to their current positions, so replaying one that was applied moves them twice
+  is_reorder = method == 'PUT' and isinstance(data, dict) and 'range_start' in data
+  return method != 'POST' and not is_reorder
+
+def _check_retryable(status_code: int, idempotent: bool) -> bool:
+  if status_code == 429:
+    return True
+  # a failed POST or reorder may still have been applied, so only idempotent calls are retried on 5xx
+  return status_code >= 500 and idempotent
+
+def _get_endpoint_label(method: str, url: str) -> str:
+  path = urlparse.urlparse(url).path
+  for base_url in BASE_URLS.values():
+    path = path.removeprefix(urlparse.urlparse(base_url).path)
+  segments = path.split('/')
+  # ids follow their collection name, so /playlists/abc/tracks becomes /playlists/{id}/tracks
+  labels = [
+    '{id}' if i > 1 and segments[i - 1] in ('playlists', 'tracks', 'users', 'audio-analysis') else segment
+    for i, segment in enumerate(segments)
+  ]
+  return f'api.{method} {"/".join(labels)}'
+
+def _record_response(label: str, r: requests.Response | httpx.Response, seconds: float) -> None:
+  metrics.observe(label, seconds)
+  metrics.count(f'api.status.{r.status_code}')
+  metrics.count('api.bytes_received', len(r.content))
+
+def _get_retry_after(headers) -> float | None:
+  try:
+    return float(headers['Retry-After'])
+  except (KeyError, ValueError):
+    return None
+
+def _get_backoff_delay(attempt: int) -> float:
+  return random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+def _get_stored_refresh_token() -> str | None:
+  if not os.path.exists(REFRESH_TOKEN_FP):
+    return
+  with open(REFRESH_TOKEN_FP, mode='r', encoding='utf8') as f:
+    return f.read().strip()
+
+def _store_refresh_token(token: str) -> None:
+  # write through a temporary file so a crash can never leave a truncated token behind
+  tmp_filepath = f'{REFRESH_TOKEN_FP}.{os.getpid()}.tmp'
+  with open(tmp_filepath, mode='w', encoding='utf8') as f:
+    f.write(token)
+  os.replace(tmp_filepath, REFRESH_TOKEN_FP)
+
+def _get_token_expires_at(data: dict) -> float:
+  return monotonic() + data.get('expires_in', 3600) - TOKEN_REFRESH_MARGIN
+
+def _get_token_refresh_kwargs(base_64: str, refresh_token: str) -> dict:
+  return {
+    'target': 'auth',
+    'data': {
+      'grant_type': 'refresh_token',
+      'refresh_token': refresh_token
+    },
+    'headers': {
+      'Authorization': f'Basic {base_64}'
+    }
+  }
+
+def _set_access_token(api: 'SpotifyAPI | AsyncSpotifyAPI', data: dict) -> None:
+  api.access_token = data['access_token']
+  api.access_token_expires_at = _get_token_expires_at(data)
+  api.access_token_version += 1
+  if 'scope' in data:
+    api.granted_scopes = set(data['scope'].split())
+  if (refresh_token := data.get('refresh_token')) and refresh_token != api.refresh_token:
+    api.refresh_token = refresh_token
+    _store_refresh_token(api.refresh_token)
+
+def _get_default_json_headers(access_token: str | None) -> dict[str, str]:
+  return {
+    'Content-Type': 'application/json',
+    'Authorization': f'Bearer {access_token}'
+  }
+
+def _confirm_resource_found(data: dict[str, dict]) -> bool:
+  return type(data) is not dict or data.get('error', {}).get('status') != 404
+
+def _confirm_access_token_valid(data: dict[str, dict]) -> bool:
+  return type(data) is not dict or data.get('error', {}).get('status') != 401
+
+def _handle_errors(data: dict[str, dict]) -> None:
+  if type(data) is not dict:
+    return
+  if error := data.get('error'):
+    raise SpotifyError(error.get('status'), error.get('message'))
+
 class SpotifyError(Exception): ...
 
 
+@dataclass
+class RateLimiter:
+  requests_per_second: float | None = None
+  lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+  next_slot_at: float = field(init=False, default=0)
+  blocked_until: float = field(init=False, default=0)
+  request_count: int = field(init=False, default=0)
+
+  def wait(self) -> None:
+    if delay := self.reserve():
+      sleep(delay)
+
+  def reserve(self) -> float:
+    with self.lock:
+      self.request_count += 1
+      now = monotonic()
+      slot_at = max(now, self.next_slot_at, self.blocked_until)
+      if self.requests_per_second:
+        self.next_slot_at = slot_at + 1 / self.requests_per_second
+    return slot_at - now
+
+  def block(self, seconds: float) -> None:
+    with self.lock:
+      self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+
+
 @dataclass
 class SpotifyAPI:
   client_id: str = field(kw_only=True)
   client_secret: str = field(kw_only=True)
   redirect_uri: str = field(kw_only=True)
+  max_retries: int = field(kw_only=True, default=5)
+  rate_limiter: RateLimiter = field(kw_only=True, default_factory=RateLimiter)
+  http_cache: HTTPCache | None = field(kw_only=True, default=None)
+  page_window: int = field(kw_only=True, default=1)
+  pool_size: int = field(kw_only=True, default=DEFAULT_POOLSIZE)
   
   base_64: bytes = field(init=False)
-  access_token: str = field(init=False)
+  access_token: str | None = field(init=False, default=None)
+  access_token_expires_at: float = field(init=False, default=0)
+  access_token_version: int = field(init=False, default=0)
   refresh_token: str = field(init=False)
+  granted_scopes: set[str] | None = field(init=False, default=None)
+  token_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+  current_user: dict[str, str] | None = field(init=False, default=None)
+  session: requests.Session = field(init=False)
+  pager: ThreadPoolExecutor | None = field(init=False, default=None)
 
   class Decorators:
-    @classmethod
-    def __confirm_resource_found(cls, data: dict[str, dict]):
-      return type(data) is not dict or data.get('error', {}).get('status') != 404
-    
-    @classmethod
-    def __confirm_access_token_valid(cls, data: dict[str, dict]):
-      return type(data) is not dict or data.get('error', {}).get('status') != 401
-    
-    @classmethod
-    def __handle_errors(cls, data: dict[str, dict]):
-      if type(data) is not dict:
-        return
-      if error := data.get('error'):
-        raise SpotifyError(error.get('status'), error.get('message'))
-
     @classmethod
     def validator(cls, func):
       @wraps(func)
       def inner(*args, **kwargs):
         this: SpotifyAPI = args[0]
-        if kwargs.get('target') == 'api' and not this._check_authorized():
+        is_api = kwargs.get('target', 'api') == 'api'
+        if is_api and not this._check_authorized():
           raise SpotifyError('Unauthorized: refresh_token.txt file not found')
+        if is_api and monotonic() >= this.access_token_expires_at:
+          this._refetch_access_token(stale_version=this.access_token_version)
+        access_token_version = this.access_token_version
         result: dict = func(*args, **kwargs)
-        if not cls.__confirm_access_token_valid(result):
-          this._refetch_access_token()
+        if is_api and not _confirm_access_token_valid(result):
+          this._refetch_access_token(stale_version=access_token_version)
           result = func(*args, **kwargs)
-        if not cls.__confirm_resource_found(result):
+        if not _confirm_resource_found(result):
           return None
-        cls.__handle_errors(result)
+        _handle_errors(result)
         return result
       return inner
 
   def __post_init__(self):
+    self.session = requests.Session()
+    # connections beyond the pool are closed after use, so it has to fit every thread sending at once
+    self.session.mount('https://', HTTPAdapter(pool_maxsize=self.pool_size))
+    self.session.mount('http://', HTTPAdapter(pool_maxsize=self.pool_size))
     self.base_64 = self.__get_b64encoded_credentials()
     self.__set_refresh_token()
     if not self._check_authorized():
@@ -123,20 +346,45 @@ class SpotifyAPI:
   def get_playlist(self, playlist_id: str) -> SpotifyPlaylist | None:
     item = self.__get_playlist_item(playlist_id)
     if not item: return
-    return self.__instantiate_playlist(item)
+    return _instantiate_playlist(item)
 
-  def get_playlist_tracks(self, playlist_id: str) -> Generator[SpotifyTrack, None, None]:
+  def get_playlist_metadata(self, playlist_id: str, fields: str = PLAYLIST_METADATA_FIELDS) -> SpotifyPlaylist | None:
+    item = self.__get(f'/playlists/{playlist_id}', params={ 'fields': fields })
+    if not item: return
+    return _instantiate_playlist(item)
+
+  def get_playlist_snapshot_id(self, playlist_id: str) -> str | None:
+    item = self.__get(f'/playlists/{playlist_id}', params={ 'fields': 'snapshot_id' })
+    if not item: return
+    return item['snapshot_id']
+
+  def get_playlist_tracks(self, playlist_id: str, keep_positions: bool = False) -> Generator[SpotifyTrack | None, None, None]:
+    # with keep_positions, items that aren't tracks come through as None so indices match the playlist
     for item in self.__get_playlist_track_items(playlist_id):
-      yield self.__instantiate_track(item)
+      if _check_track_item(item):
+        yield _instantiate_track(item)
+      elif keep_positions:
+        yield None
   
+  def get_playlist_track_pages(self, playlist_id: str) -> Generator[list[SpotifyTrack], None, None]:
+    for items in self.__get_playlist_track_item_pages(playlist_id):
+      yield [_instantiate_track(item) for item in items if _check_track_item(item)]
+
   def get_track(self, track_id: str) -> SpotifyTrack | None:
     item = self.__get_track_item(track_id)
     if not item: return
-    return self.__instantiate_track(item)
+    return _instantiate_track(item)
   
   def get_track_analytics(self, track: SpotifyTrack) -> SpotifyTrack:
     data = self.__get_track_analysis(track.id)
-    self.__set_track_analytics(track, data)
+    _set_track_analytics(track, data)
+
+  def get_tracks_analytics(self, tracks: list[SpotifyTrack]) -> None:
+    for chunk in chunk_list(tracks, 100):
+      items = self.__get_tracks_audio_features([track.id for track in chunk])
+      for track, features in zip(chunk, items):
+        if features:
+          _set_track_features(track, features)
   
   def create_playlist(self, name: str, description: str = '', img_base64_str: str = '') -> SpotifyPlaylist:
     playlist_id = self.__create_playlist(name, description)
@@ -161,17 +409,33 @@ class SpotifyAPI:
   def check_following_playlist(self, playlist_id: str) -> bool:
     user_id = self.get_current_user_id()
     params = { 'ids': [user_id] }
-    [following] = self.__get(f'/playlists/{playlist_id}/followers/contains', params=params)
-    return following
+    data = self.__get(f'/playlists/{playlist_id}/followers/contains', params=params)
+    return bool(data and data[0])
   
   def get_current_user(self) -> dict[str, str]:
-    return self.__get('/me')
+    # the user can't change mid-session, so /me is fetched once
+    if self.current_user is None:
+      self.current_user = self.__get('/me')
+    return self.current_user
+
+  def get_followed_playlist_snapshots(self) -> dict[str, str | None]:
+    return {item['id']: item.get('snapshot_id') for item in self.__iterate_all('/me/playlists', params=FOLLOWED_PLAYLISTS_PARAMS) if item}
   
-  def add_playlist_tracks(self, *, playlist_id: str, track_ids=list[str]):
+  def add_playlist_tracks(self, *, playlist_id: str, track_ids: list[str], position: int | None = None):
+    data = {'uris': [f'spotify:track:{track_id}' for track_id in track_ids]}
+    if position is not None:
+      data['position'] = position
+    return self.__post(f'/playlists/{playlist_id}/tracks', data=data)
+
+  def replace_playlist_tracks(self, *, playlist_id: str, track_ids: list[str]):
     track_uris = [f'spotify:track:{track_id}' for track_id in track_ids]
-    return self.__post(f'/playlists/{playlist_id}/tracks', data={'uris': track_uris})
+    return self.__put(f'/playlists/{playlist_id}/tracks', data={'uris': track_uris})
+
+  def reorder_playlist_tracks(self, *, playlist_id: str, range_start: int, insert_before: int, range_length: int = 1):
+    data = {'range_start': range_start, 'insert_before': insert_before, 'range_length': range_length}
+    return self.__put(f'/playlists/{playlist_id}/tracks', data=data)
   
-  def delete_playlist_tracks(self, *, playlist_id: str, track_ids=list[str]):
+  def delete_playlist_tracks(self, *, playlist_id: str, track_ids: list[str]):
     track_uris = [{'uri': f'spotify:track:{track_id}'} for track_id in track_ids]
     return self.__delete(f'/playlists/{playlist_id}/tracks', data={'tracks': track_uris})
   
@@ -179,50 +443,60 @@ class SpotifyAPI:
     return self.__get(f'/playlists/{playlist_id}')
 
   def __get_playlist_track_items(self, playlist_id: str) -> Generator[dict, None, None]:
-    return self.__iterate_all(f'/playlists/{playlist_id}/tracks')
+    return self.__iterate_all(f'/playlists/{playlist_id}/tracks', params=PLAYLIST_TRACKS_PARAMS)
+
+  def __get_playlist_track_item_pages(self, playlist_id: str) -> Generator[list[dict], None, None]:
+    return self.__iterate_pages(f'/playlists/{playlist_id}/tracks', params=PLAYLIST_TRACKS_PARAMS)
 
   def __get_track_item(self, track_id: str) -> dict | None:
     return self.__get(f'/tracks/{track_id}') 
   
   def __get_track_analysis(self, track_id: str) -> dict:
     return self.__get(f'/audio-analysis/{track_id}')
-  
-  def __instantiate_playlist(self, data: dict):
-    _id = data['id']
-    _name = data['name']
-    _images = data['images']
-    return SpotifyPlaylist(
-      id=_id,
-      name=_name,
-      images=_images
-    )
 
-  def __instantiate_track(self, data: dict):
-    _data_track = data.get('track', data)
-    _id = _data_track['id']
-    _name = _data_track['name']
-    _artist = ', '.join(artist['name'] for artist in _data_track['artists'])
-    return SpotifyTrack(
-      id=_id,
-      name=_name,
-      artist=_artist
-    )
+  def __get_tracks_audio_features(self, track_ids: list[str]) -> list[dict | None]:
+    data = self.__get('/audio-features', params={ 'ids': ','.join(track_ids) })
+    return data['audio_features']
   
-  def __set_track_analytics(self, track: SpotifyTrack, analytics: dict):
-    track.set_analytics(
-      key = analytics['track']['key'],
-      mode = analytics['track']['mode'],
-      tempo = analytics['track']['tempo']
-    )
-
-  def __iterate_all(self, url: str) -> Generator[dict, None, None]:
-    while url:
-      result = self.__get(url)
-      for item in result['items']:
+  def __iterate_all(self, url: str, *, params={}) -> Generator[dict, None, None]:
+    for items in self.__iterate_pages(url, params=params):
+      for item in items:
         yield item
-      url = result['next']
-      if url:
-        url = url.replace(BASE_URLS['api'], '')
+
+  def __iterate_pages(self, url: str, *, params={}) -> Generator[list[dict], None, None]:
+    result = self.__get(url, params=params)
+    offsets = _get_remaining_offsets(result)
+    if self.page_window < 1 or offsets is None:
+      yield from self.__iterate_pages_sequentially(url, params=params, result=result)
+      return
+    # the first page reveals the total, so up to page_window later pages stay in flight while the caller consumes one
+    if not self.pager:
+      self.pager = ThreadPoolExecutor(max_workers=self.page_window, thread_name_prefix='pager')
+    offsets = iter(offsets)
+    pending: deque[Future] = deque()
+
+    def top_up() -> None:
+      while len(pending) < self.page_window and (offset := next(offsets, None)) is not None:
+        pending.append(self.pager.submit(self.__get, url, params={**params, 'offset': offset, 'limit': result['limit']}))
+
+    try:
+      top_up()
+      yield result['items']
+      while pending:
+        page = pending.popleft().result()
+        top_up()
+        yield page['items']
+    finally:
+      for future in pending:
+        future.cancel()
+
+  def __iterate_pages_sequentially(self, url: str, *, params={}, result: dict) -> Generator[list[dict], None, None]:
+    while True:
+      yield result['items']
+      url, params = _get_next_page(result.get('next'), params)
+      if not url:
+        return
+      result = self.__get(url, params=params)
 
   # AUTH
 
@@ -237,18 +511,12 @@ class SpotifyAPI:
   def _check_authorized(self) -> bool:
     return bool(self.refresh_token)
 
-  def __store_refresh_token(self, token: str) -> None:
-    with open(REFRESH_TOKEN_FP, mode='w', encoding='utf8') as f:
-      f.write(token)
-  
-  def __get_stored_refresh_token(self) -> str | None:
-    if not os.path.exists(REFRESH_TOKEN_FP):
-      return
-    with open(REFRESH_TOKEN_FP, mode='r', encoding='utf8') as f:
-      return f.read().strip()
-    
+  def check_scopes_granted(self) -> bool:
+    # tokens issued before a scope was added keep their old grant until the user authorizes again
+    return self.granted_scopes is not None and set(SCOPES) <= self.granted_scopes
+
   def __set_refresh_token(self) -> None:
-    self.refresh_token = self.__get_stored_refresh_token()
+    self.refresh_token = _get_stored_refresh_token()
     
   def __get_authorization_url(self) -> str:
     url = f'{BASE_URLS["auth"]}/authorize'
@@ -292,25 +560,15 @@ class SpotifyAPI:
         'Authorization': f'Basic {self.base_64}'
       }
     )
-    self.access_token = data['access_token']
-    self.refresh_token = data['refresh_token']
-    self.__store_refresh_token(self.refresh_token)
+    _set_access_token(self, data)
 
-  def _refetch_access_token(self) -> None:
-    data = self.__post(
-      '/api/token',
-      target='auth',
-      data={
-        'grant_type': 'refresh_token',
-        'refresh_token': self.refresh_token
-      },
-      headers={
-        'Authorization': f'Basic {self.base_64}'
-      }
-    )
-    self.access_token = data['access_token']
-    self.refresh_token = data.get('refresh_token', self.refresh_token)
-    self.__store_refresh_token(self.refresh_token)
+  def _refetch_access_token(self, *, stale_version: int | None = None) -> None:
+    # single flight: callers that queued behind a refresh reuse its token
+    with self.token_lock:
+      if stale_version is not None and self.access_token_version != stale_version:
+        return
+      data = self.__post('/api/token', **_get_token_refresh_kwargs(self.base_64, self.refresh_token))
+      _set_access_token(self, data)
 
   # HTTP
 
@@ -358,13 +616,51 @@ class SpotifyAPI:
   def __request(self, endpoint, *, method=Literal['GET', 'POST', 'PUT', 'DELETE'], target: BaseUrlTarget = 'api', headers={}, params={}, data={}) -> dict | list | None:
     base_url = self.__get_base_url(target)
     self.__validate_endpoint_syntax(endpoint)
-    r = requests.request(
-      method=method,
-      url=base_url+endpoint,
-      **self.__set_request_kwargs(params=params, data=data, headers=headers, target=target)
-    )
+    kwargs = self.__set_request_kwargs(params=params, data=data, headers=headers, target=target)
+    if self.http_cache and method == 'GET' and target == 'api' and HTTP_CACHE_ENDPOINT_PATTERN.match(endpoint):
+      return self.__send_cached(url=base_url+endpoint, **kwargs)
+    r = self.__send(method=method, url=base_url+endpoint, idempotent=_check_idempotent(method, data), **kwargs)
     return self.__parse_res_json(r)
-  
+
+  def __send_cached(self, *, url: str, **kwargs) -> dict | list | None:
+    cache_key = HTTPCache.get_key(url, kwargs.get('params', {}))
+    cache_entry = self.http_cache.get(cache_key)
+    if cache_entry:
+      kwargs['headers'] = {**kwargs['headers'], 'If-None-Match': cache_entry.etag}
+    r = self.__send(method='GET', url=url, idempotent=True, **kwargs)
+    if r.status_code == 304 and cache_entry:
+      self.http_cache.count_not_modified()
+      return json.loads(cache_entry.body)
+    if r.status_code == 200 and (etag := r.headers.get('ETag')):
+      self.http_cache.store(cache_key, etag, r.content)
+    return self.__parse_res_json(r)
+
+  def __send(self, *, method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+    label = _get_endpoint_label(method, url)
+    for attempt in range(self.max_retries + 1):
+      is_last_attempt = attempt == self.max_retries
+      if attempt:
+        metrics.count('api.retries')
+      with metrics.timer('api.rate_limiter_wait'):
+        self.rate_limiter.wait()
+      started_at = monotonic()
+      try:
+        r = self.session.request(method=method, url=url, timeout=REQUEST_TIMEOUT, **kwargs)
+      except (requests.ConnectionError, requests.Timeout):
+        metrics.count('api.connection_errors')
+        if is_last_attempt or not idempotent:
+          raise
+        sleep(_get_backoff_delay(attempt))
+        continue
+      _record_response(label, r, monotonic() - started_at)
+      if is_last_attempt or not _check_retryable(r.status_code, idempotent):
+        return r
+      if r.status_code == 429:
+        retry_after = _get_retry_after(r.headers)
+        self.rate_limiter.block(_get_backoff_delay(attempt) if retry_after is None else retry_after)
+      else:
+        sleep(_get_backoff_delay(attempt))
+
   def __get_base_url(self, target: BaseUrlTarget) -> str:
     options = list(BASE_URLS.keys())
     if target not in options:
@@ -382,7 +678,7 @@ class SpotifyAPI:
     if headers:
       kwargs['headers'] = headers
     else:
-      headers = self.__get_default_json_headers()
+      headers = _get_default_json_headers(self.access_token)
       kwargs['headers'] = headers
     if data:
       if headers.get('Content-Type') == 'application/json':
@@ -390,20 +686,283 @@ class SpotifyAPI:
       kwargs['data'] = data
     return kwargs
   
-  def __get_default_json_headers(self) -> dict[str, str]:
-    return {
-      'Content-Type': 'application/json',
-      'Authorization': f'Bearer {self.access_token}'
-    }
-  
   def __combine_headers_with_default(self, headers: dict) -> dict[str, str]:
-    return {**self.__get_default_json_headers(), **headers}
+    return {**_get_default_json_headers(self.access_token), **headers}
 
   def __parse_res_json(self, response: requests.Response) -> dict[str, str] | list | None:
     try:
       data: dict[str, str] = response.json()
     except json.JSONDecodeError:
+      if response.status_code >= 400:
+        return { 'error': { 'status': response.status_code, 'message': response.reason } }
       return
     if type(data) is dict and data.get('error', {}).get('message') == 'Error parsing JSON.':
       data = json.loads(response.content)
     return data
+
+
+@dataclass
+class AsyncSpotifyAPI:
+  client_id: str = field(kw_only=True)
+  client_secret: str = field(kw_only=True)
+  redirect_uri: str = field(kw_only=True)
+  max_retries: int = field(kw_only=True, default=5)
+  max_concurrency: int = field(kw_only=True, default=8)
+  rate_limiter: RateLimiter = field(kw_only=True, default_factory=RateLimiter)
+
+  base_64: bytes = field(init=False)
+  access_token: str | None = field(init=False, default=None)
+  access_token_expires_at: float = field(init=False, default=0)
+  access_token_version: int = field(init=False, default=0)
+  refresh_token: str = field(init=False)
+  granted_scopes: set[str] | None = field(init=False, default=None)
+  token_lock: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+  current_user: dict[str, str] | None = field(init=False, default=None)
+  client: httpx.AsyncClient = field(init=False)
+  semaphore: asyncio.Semaphore = field(init=False)
+
+  class Decorators:
+    @classmethod
+    def validator(cls, func):
+      @wraps(func)
+      async def inner(*args, **kwargs):
+        this: AsyncSpotifyAPI = args[0]
+        is_api = kwargs.get('target', 'api') == 'api'
+        if is_api and not this._check_authorized():
+          raise SpotifyError('Unauthorized: refresh_token.txt file not found')
+        if is_api and monotonic() >= this.access_token_expires_at:
+          await this._refetch_access_token(stale_version=this.access_token_version)
+        access_token_version = this.access_token_version
+        result: dict = await func(*args, **kwargs)
+        if is_api and not _confirm_access_token_valid(result):
+          await this._refetch_access_token(stale_version=access_token_version)
+          result = await func(*args, **kwargs)
+        if not _confirm_resource_found(result):
+          return None
+        _handle_errors(result)
+        return result
+      return inner
+
+  def __post_init__(self):
+    limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+    self.client = httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT)
+    self.semaphore = asyncio.Semaphore(self.max_concurrency)
+    self.base_64 = b64encode((f'{self.client_id}:{self.client_secret}').encode('ascii')).decode('ascii')
+    self.refresh_token = _get_stored_refresh_token()
+
+  async def __aenter__(self) -> 'AsyncSpotifyAPI':
+    if self._check_authorized():
+      await self._refetch_access_token()
+    return self
+
+  async def __aexit__(self, *_):
+    await self.client.aclose()
+
+  # REQUESTS
+
+  async def get_playlist(self, playlist_id: str) -> SpotifyPlaylist | None:
+    item = await self.__get(f'/playlists/{playlist_id}')
+    if not item: return
+    return _instantiate_playlist(item)
+
+  async def get_playlist_metadata(self, playlist_id: str, fields: str = PLAYLIST_METADATA_FIELDS) -> SpotifyPlaylist | None:
+    item = await self.__get(f'/playlists/{playlist_id}', params={ 'fields': fields })
+    if not item: return
+    return _instantiate_playlist(item)
+
+  async def get_playlist_snapshot_id(self, playlist_id: str) -> str | None:
+    item = await self.__get(f'/playlists/{playlist_id}', params={ 'fields': 'snapshot_id' })
+    if not item: return
+    return item['snapshot_id']
+
+  async def get_playlist_tracks(self, playlist_id: str, keep_positions: bool = False) -> AsyncGenerator[SpotifyTrack | None, None]:
+    async for items in self.__iterate_pages(f'/playlists/{playlist_id}/tracks', params=PLAYLIST_TRACKS_PARAMS):
+      for item in items:
+        if _check_track_item(item):
+          yield _instantiate_track(item)
+        elif keep_positions:
+          yield None
+
+  async def get_playlist_track_pages(self, playlist_id: str) -> AsyncGenerator[list[SpotifyTrack], None]:
+    async for items in self.__iterate_pages(f'/playlists/{playlist_id}/tracks', params=PLAYLIST_TRACKS_PARAMS):
+      yield [_instantiate_track(item) for item in items if _check_track_item(item)]
+
+  async def get_track(self, track_id: str) -> SpotifyTrack | None:
+    item = await self.__get(f'/tracks/{track_id}')
+    if not item: return
+    return _instantiate_track(item)
+
+  async def get_track_analytics(self, track: SpotifyTrack) -> None:
+    data = await self.__get(f'/audio-analysis/{track.id}')
+    _set_track_analytics(track, data)
+
+  async def get_tracks_analytics(self, tracks: list[SpotifyTrack]) -> None:
+    await asyncio.gather(*(self.__set_tracks_features(chunk) for chunk in chunk_list(tracks, 100)))
+
+  async def create_playlist(self, name: str, description: str = '', img_base64_str: str = '') -> SpotifyPlaylist:
+    user_id = await self.get_current_user_id()
+    data = await self.__request(f'/users/{user_id}/playlists', method='POST', data={ 'name': name, 'description': description })
+    playlist_id = data.get('id')
+    if img_base64_str:
+      await self.__request(
+        f'/playlists/{playlist_id}/images',
+        method='PUT',
+        headers={**_get_default_json_headers(self.access_token), 'Content-Type': 'image/jpeg'},
+        data=img_base64_str
+      )
+    return await self.get_playlist(playlist_id)
+
+  async def get_current_user_id(self) -> str | None:
+    data = await self.get_current_user()
+    return data['id']
+
+  async def check_following_playlist(self, playlist_id: str) -> bool:
+    user_id = await self.get_current_user_id()
+    params = { 'ids': [user_id] }
+    data = await self.__get(f'/playlists/{playlist_id}/followers/contains', params=params)
+    return bool(data and data[0])
+
+  async def get_current_user(self) -> dict[str, str]:
+    if self.current_user is None:
+      self.current_user = await self.__get('/me')
+    return self.current_user
+
+  async def get_followed_playlist_snapshots(self) -> dict[str, str | None]:
+    followed_snapshots = {}
+    async for items in self.__iterate_pages('/me/playlists', params=FOLLOWED_PLAYLISTS_PARAMS):
+      followed_snapshots.update((item['id'], item.get('snapshot_id')) for item in items if item)
+    return followed_snapshots
+
+  async def add_playlist_tracks(self, *, playlist_id: str, track_ids: list[str], position: int | None = None):
+    data = {'uris': [f'spotify:track:{track_id}' for track_id in track_ids]}
+    if position is not None:
+      data['position'] = position
+    return await self.__request(f'/playlists/{playlist_id}/tracks', method='POST', data=data)
+
+  async def replace_playlist_tracks(self, *, playlist_id: str, track_ids: list[str]):
+    track_uris = [f'spotify:track:{track_id}' for track_id in track_ids]
+    return await self.__request(f'/playlists/{playlist_id}/tracks', method='PUT', data={'uris': track_uris})
+
+  async def reorder_playlist_tracks(self, *, playlist_id: str, range_start: int, insert_before: int, range_length: int = 1):
+    data = {'range_start': range_start, 'insert_before': insert_before, 'range_length': range_length}
+    return await self.__request(f'/playlists/{playlist_id}/tracks', method='PUT', data=data)
+
+  async def delete_playlist_tracks(self, *, playlist_id: str, track_ids: list[str]):
+    track_uris = [{'uri': f'spotify:track:{track_id}'} for track_id in track_ids]
+    return await self.__request(f'/playlists/{playlist_id}/tracks', method='DELETE', data={'tracks': track_uris})
+
+  async def __set_tracks_features(self, tracks: list[SpotifyTrack]) -> None:
+    data = await self.__get('/audio-features', params={ 'ids': ','.join(track.id for track in tracks) })
+    for track, features in zip(tracks, data['audio_features']):
+      if features:
+        _set_track_features(track, features)
+
+  async def __iterate_pages(self, url: str, *, params={}) -> AsyncGenerator[list[dict], None]:
+    result = await self.__get(url, params=params)
+    offsets = _get_remaining_offsets(result)
+    if offsets is None:
+      yield result['items']
+      url, params = _get_next_page(result.get('next'), params)
+      while url:
+        result = await self.__get(url, params=params)
+        yield result['items']
+        url, params = _get_next_page(result.get('next'), params)
+      return
+    # later pages go out together and are yielded in order, the semaphore bounds them
+    offsets = iter(offsets)
+    pending: deque[asyncio.Task] = deque()
+
+    def top_up() -> None:
+      while len(pending) < self.max_concurrency and (offset := next(offsets, None)) is not None:
+        pending.append(asyncio.ensure_future(self.__get(url, params={**params, 'offset': offset, 'limit': result['limit']})))
+
+    try:
+      top_up()
+      yield result['items']
+      while pending:
+        page = await pending.popleft()
+        top_up()
+        yield page['items']
+    finally:
+      for task in pending:
+        task.cancel()
+
+  # AUTH
+
+  def _check_authorized(self) -> bool:
+    return bool(self.refresh_token)
+
+  async def _refetch_access_token(self, *, stale_version: int | None = None) -> None:
+    # single flight: coroutines that queued behind a refresh reuse its token
+    async with self.token_lock:
+      if stale_version is not None and self.access_token_version != stale_version:
+        return
+      data = await self.__request('/api/token', method='POST', **_get_token_refresh_kwargs(self.base_64, self.refresh_token))
+      _set_access_token(self, data)
+
+  # HTTP
+
+  async def __get(self, endpoint, *, params={}):
+    return await self.__request(endpoint, method='GET', params=params)
+
+  @Decorators.validator
+  async def __request(self, endpoint, *, method=Literal['GET', 'POST', 'PUT', 'DELETE'], target: BaseUrlTarget = 'api', headers={}, params={}, data={}) -> dict | list | None:
+    if not endpoint.startswith('/'):
+      raise SyntaxError('Endpoint must start with forward slash')
+    r = await self.__send(
+      method=method,
+      url=BASE_URLS[target]+endpoint,
+      idempotent=_check_idempotent(method, data),
+      **self.__set_request_kwargs(params=params, data=data, headers=headers)
+    )
+    return self.__parse_res_json(r)
+
+  async def __send(self, *, method: str, url: str, idempotent: bool, **kwargs) -> httpx.Response:
+    label = _get_endpoint_label(method, url)
+    for attempt in range(self.max_retries + 1):
+      is_last_attempt = attempt == self.max_retries
+      if attempt:
+        metrics.count('api.retries')
+      await asyncio.sleep(self.rate_limiter.reserve())
+      try:
+        async with self.semaphore:
+          started_at = monotonic()
+          r = await self.client.request(method, url, **kwargs)
+      except httpx.TransportError:
+        metrics.count('api.connection_errors')
+        if is_last_attempt or not idempotent:
+          raise
+        await asyncio.sleep(_get_backoff_delay(attempt))
+        continue
+      _record_response(label, r, monotonic() - started_at)
+      if is_last_attempt or not _check_retryable(r.status_code, idempotent):
+        return r
+      if r.status_code == 429:
+        retry_after = _get_retry_after(r.headers)
+        self.rate_limiter.block(_get_backoff_delay(attempt) if retry_after is None else retry_after)
+      else:
+        await asyncio.sleep(_get_backoff_delay(attempt))
+
+  def __set_request_kwargs(self, *, params={}, data={}, headers={}) -> dict:
+    kwargs = {}
+    if params:
+      kwargs['params'] = params
+    kwargs['headers'] = headers or _get_default_json_headers(self.access_token)
+    if not data:
+      return kwargs
+    if type(data) is dict and kwargs['headers'].get('Content-Type') == 'application/json':
+      kwargs['content'] = json.dumps(data)
+    elif type(data) is dict:
+      kwargs['data'] = data
+    else:
+      kwargs['content'] = data
+    return kwargs
+
+
+  def __parse_res_json(self, response: httpx.Response) -> dict[str, str] | list | None:
+    try:
+      return response.json()
+    except json.JSONDecodeError:
+      if response.status_code >= 400:
+        return { 'error': { 'status': response.status_code, 'message': response.reason_phrase } }
+      return
@@ -0,0 +1,148 @@
+from bisect import bisect_left, insort
+from collections import Counter
+from dataclasses import dataclass, field
+
+from utils.misc import chunk_list
+
+CHUNK_SIZE = 100
+
+
+@dataclass
+class SyncMove:
+  range_start: int
+  insert_before: int
+
+@dataclass
+class SyncInsert:
+  position: int
+  track_ids: list[str]
+
+@dataclass
+class SyncPlan:
+  remove_track_ids: list[str] = field(default_factory=list)
+  moves: list[SyncMove] = field(default_factory=list)
+  inserts: list[SyncInsert] = field(default_factory=list)
+  replace_track_ids: list[str] | None = None
+
+  @property
+  def is_empty(self) -> bool:
+    return self.replace_track_ids is None and not (self.remove_track_ids or self.moves or self.inserts)
+
+  def count_requests(self) -> int:
+    if self.replace_track_ids is not None:
+      return max(len(list(chunk_list(self.replace_track_ids, CHUNK_SIZE))), 1)
+    return len(list(chunk_list(self.remove_track_ids, CHUNK_SIZE))) + len(self.moves) + len(self.inserts)
+
+
+def plan_sync(current_ids: list[str | None], desired_ids: list[str]) -> SyncPlan:
+  # None marks items that can't be addressed by uri (local files, unavailable tracks), they are left where they are
+  if current_ids == desired_ids:
+    return SyncPlan()
+  replace_plan = SyncPlan(replace_track_ids=list(desired_ids))
+  has_unaddressable = None in current_ids
+  track_counts = Counter(track_id for track_id in current_ids if track_id is not None)
+
+  desired_positions = {track_id: i for i, track_id in enumerate(desired_ids)}
+  # removals go by uri and drop every occurrence, so duplicated tracks are removed and added back once
+  kept_ids = [track_id for track_id in current_ids if track_id in desired_positions and track_counts[track_id] == 1]
+  kept_id_set = set(kept_ids)
+  remove_track_ids = list(dict.fromkeys(track_id for track_id in current_ids if track_id is not None and track_id not in kept_id_set))
+  kept_positions = [desired_positions[track_id] for track_id in kept_ids]
+  stable_positions = _get_longest_increasing_subsequence(kept_positions)
+  moving_positions = sorted(set(kept_positions) - set(stable_positions))
+  added_positions = [i for i, track_id in enumerate(desired_ids) if track_id not in kept_id_set]
+  inserts = _group_inserts(added_positions, desired_ids)
+
+  # every out-of-order track costs one reorder call, so heavy reshuffles are cheaper to rewrite,
+  # unless the rewrite would drop items that can't be added back
+  diff_requests = len(list(chunk_list(remove_track_ids, CHUNK_SIZE))) + len(moving_positions) + len(inserts)
+  if not has_unaddressable and diff_requests >= replace_plan.count_requests():
+    return replace_plan
+  moves = _get_moves(kept_positions, stable_positions, moving_positions)
+  if has_unaddressable:
+    moves, inserts = _get_playlist_positions(current_ids, set(remove_track_ids), moves, inserts)
+  return SyncPlan(
+    remove_track_ids=remove_track_ids,
+    moves=moves,
+    inserts=inserts
+  )
+
+def _get_longest_increasing_subsequence(values: list[int]) -> list[int]:
+  tails: list[int] = []
+  tail_indices: list[int] = []
+  previous: list[int] = [-1] * len(values)
+  for i, value in enumerate(values):
+    k = bisect_left(tails, value)
+    if k == len(tails):
+      tails.append(value)
+      tail_indices.append(i)
+    else:
+      tails[k] = value
+      tail_indices[k] = i
+    previous[i] = tail_indices[k - 1] if k else -1
+  subsequence: list[int] = []
+  i = tail_indices[-1] if tail_indices else -1
+  while i != -1:
+    subsequence.append(values[i])
+    i = previous[i]
+  return subsequence[::-1]
+
+def _group_inserts(positions: list[int], desired_ids: list[str]) -> list[SyncInsert]:
+  inserts: list[SyncInsert] = []
+  for position in positions:
+    last = inserts[-1] if inserts else None
+    if last and last.position + len(last.track_ids) == position and len(last.track_ids) < CHUNK_SIZE:
+      last.track_ids.append(desired_ids[position])
+    else:
+      inserts.append(SyncInsert(position, [desired_ids[position]]))
+  return inserts
+
+def _get_moves(kept_positions: list[int], stable_positions: list[int], moving_positions: list[int]) -> list[SyncMove]:
+  current = list(kept_positions)
+  placed = list(stable_positions)
+  moves: list[SyncMove] = []
+  for position in moving_positions:
+    range_start = current.index(position)
+    k = bisect_left(placed, position)
+    insert_before = current.index(placed[k - 1]) + 1 if k else 0
+    insort(placed, position)
+    if insert_before in (range_start, range_start + 1):
+      continue
+    moves.append(SyncMove(range_start, insert_before))
+    current.pop(range_start)
+    current.insert(insert_before - 1 if range_start < insert_before else insert_before, position)
+  return moves
+
+def _get_playlist_positions(
+    current_ids: list[str | None],
+    removed_ids: set[str],
+    moves: list[SyncMove],
+    inserts: list[SyncInsert]
+  ) -> tuple[list[SyncMove], list[SyncInsert]]:
+  # the plan is made over the addressable tracks only, replaying it here maps every index onto the real playlist
+  playlist = [track_id for track_id in current_ids if track_id is None or track_id not in removed_ids]
+  playlist_moves: list[SyncMove] = []
+  for move in moves:
+    range_start = _get_playlist_index(playlist, move.range_start)
+    insert_before = _get_playlist_index(playlist, move.insert_before)
+    playlist_moves.append(SyncMove(range_start, insert_before))
+    track_id = playlist.pop(range_start)
+    playlist.insert(insert_before - 1 if range_start < insert_before else insert_before, track_id)
+  playlist_inserts: list[SyncInsert] = []
+  for insert in inserts:
+    position = _get_playlist_index(playlist, insert.position)
+    playlist_inserts.append(SyncInsert(position, insert.track_ids))
+    playlist[position:position] = insert.track_ids
+  return playlist_moves, playlist_inserts
+
+def _get_playlist_index(playlist: list[str | None], index: int) -> int:
+  # the index of the index-th addressable track, or just past the last one
+  last = None
+  for i, track_id in enumerate(playlist):
+    if track_id is None:
+      continue
+    if index == 0:
+      return i
+    index -= 1
+    last = i
+  return len(playlist) if last is None else last + 1
@@ -0,0 +1,27 @@
+from array import array
+from typing import Iterator
+from dataclasses import dataclass, field
+
+# stored for tracks without analytics so they sort after every real tempo
+MISSING_TEMPO = float('inf')
+
+
+@dataclass
+class TrackColumns:
+  ids: list[str] = field(default_factory=list)
+  tempos: array = field(default_factory=lambda: array('d'))
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.ids)
+
+  def append(self, track_id: str, tempo: float | None) -> None:
+    self.ids.append(track_id)
+    self.tempos.append(MISSING_TEMPO if tempo is None else tempo)
+
+  def get_ids_by_tempo(self) -> list[str]:
+    # the sort is stable, so equal tempos keep the order they were added in
+    order = sorted(range(len(self.ids)), key=self.tempos.__getitem__)
+    return [self.ids[i] for i in order]
@@ -1,10 +1,11 @@
 import os
 
 from dotenv import load_dotenv
+from requests.adapters import DEFAULT_POOLSIZE
 
 from tools.spotify import SpotifyAPI, REFRESH_TOKEN_FP
 from tools.db import SQLite, DB_FP
-from tools.prompter import PLAYLIST_IDS_FP
+from tools.prompter import PLAYLIST_IDS_FP, PLAYLIST_METADATA_WORKERS
 from utils.vars import DATA_DIRPATH
 
 
@@ -20,7 +21,7 @@ def load_env():
   env = os.path.join(os.path.dirname(__file__), '..', ENV)
   load_dotenv(env, override=True)
 
-def init_spotify() -> SpotifyAPI:
+def init_spotify(*, workers: int = 1, playlist_workers: int = 1, **kwargs) -> SpotifyAPI:
   load_env()
   SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
   SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
@@ -28,9 +29,15 @@ def init_spotify() -> SpotifyAPI:
   return SpotifyAPI(
     client_id=SPOTIFY_CLIENT_ID,
     client_secret=SPOTIFY_CLIENT_SECRET,
-    redirect_uri= SPOTIFY_REDIRECT_URI
+    redirect_uri= SPOTIFY_REDIRECT_URI,
+    pool_size=get_pool_size(workers=workers, playlist_workers=playlist_workers, page_window=kwargs.get('page_window', 1)),
+    **kwargs
   )
 
+def get_pool_size(*, workers: int, playlist_workers: int, page_window: int) -> int:
+  # analytics workers, page prefetchers and playlist workers can all hold a connection at once, and so can the prompt's metadata loaders
+  return max(workers + page_window + playlist_workers, PLAYLIST_METADATA_WORKERS, DEFAULT_POOLSIZE)
+
 def check_setup() -> bool:
   paths = [DATA_DIRPATH, PLAYLIST_IDS_FP, DB_FP, REFRESH_TOKEN_FP]
   for path in paths: